@@ -0,0 +1,132 @@
+from __future__ import print_function, absolute_import, division
+
+from collections import deque
+from threading import Condition
+from timeit import default_timer
+from time import time
+import logging
+
+from evernote.edam.error.ttypes import EDAMErrorCode, EDAMSystemException
+
+API_FOREGROUND = 0  # a note opened or a notebook listed by the user, who waits for it
+API_WRITE = 1  # uploads of local changes
+API_SYNC = 2  # background sync
+API_PREFETCH = 3
+
+# share of the hourly budget each class may use, background work is shed first as it runs low
+API_BUDGET_SHARES = {API_FOREGROUND: 1.0, API_WRITE: 0.9, API_SYNC: 0.7, API_PREFETCH: 0.5}
+API_BUDGET_PERIOD = 60 * 60  # seconds, Evernote limits the calls per user per hour
+API_BUDGET_GROWTH = 1.1  # budget growth per period without reaching the limit, up to the configured one
+API_MIN_BUDGET = 10
+API_BLOCK_DURATION = 60  # seconds, when a rate limit error does not tell how long it lasts
+
+
+class RateLimited(Exception):
+
+    def __init__(self, retry_after):
+        super(RateLimited, self).__init__('API rate limit, retry after ' + str(int(retry_after)) + ' s')
+        self.retry_after = retry_after
+
+
+class ApiDispatcher(object):
+
+    def __init__(self, note_store, calls_per_hour, foreground_wait, metrics=None):
+        """
+        All note store calls go through here.
+
+        Calls made during the last hour are counted against an estimate of the hourly limit, and
+        each priority class may only use its share of it, so prefetch and background sync stop
+        before user requests are refused. Once Evernote reports RATE_LIMIT_REACHED, no call is made
+        until rateLimitDuration has passed and the estimate is lowered to the calls that were made.
+
+        :param calls_per_hour: initial estimate of the hourly limit
+        :param foreground_wait: seconds a foreground call may wait for the limit to pass, it fails
+                                with RateLimited when the wait is longer
+        :type metrics: metrics.Metrics
+        :param metrics: records the latency of every call made, by method
+        """
+        self.note_store = note_store
+        self.max_budget = calls_per_hour
+        self.budget = calls_per_hour
+        self.budget_time = time()
+        self.foreground_wait = foreground_wait
+        self.blocked_until = 0
+        self.calls = deque()
+        self.condition = Condition()
+        self.stats = dict(calls=0, shed=0, rate_limited=0)
+        self.metrics = metrics
+
+    def call(self, priority, method, *args):
+        """
+        :param priority: one of API_FOREGROUND, API_WRITE, API_SYNC and API_PREFETCH
+        :param method: name of the note store method
+        :raise RateLimited: the call was not made, it may be retried after retry_after seconds
+        """
+        retry = priority == API_FOREGROUND
+        while True:
+            self.acquire(priority)
+            started = default_timer()
+            failed = True
+            try:
+                result = getattr(self.note_store, method)(*args)
+                failed = False
+                return result
+            except EDAMSystemException as e:
+                if e.errorCode != EDAMErrorCode.RATE_LIMIT_REACHED:
+                    raise
+                duration = e.rateLimitDuration or API_BLOCK_DURATION
+                self.rate_limited(duration)
+                if not retry or duration > self.foreground_wait:
+                    raise RateLimited(duration)
+                # a foreground call is retried once, after waiting out a short limit
+                retry = False
+            finally:
+                if self.metrics is not None:
+                    self.metrics.observe('api', method, default_timer() - started, failed)
+
+    def acquire(self, priority):
+        with self.condition:
+            while True:
+                now = time()
+                self.expire(now)
+
+                blocked = self.blocked_until - now
+                if blocked > 0:
+                    if priority == API_FOREGROUND and blocked <= self.foreground_wait:
+                        self.condition.wait(blocked)
+                        continue
+                    self.stats['shed'] += 1
+                    raise RateLimited(blocked)
+
+                allowed = int(self.budget * API_BUDGET_SHARES[priority])
+                if priority != API_FOREGROUND and len(self.calls) >= allowed:
+                    # wait until enough calls drop out of the window for this class to fit in again
+                    self.stats['shed'] += 1
+                    oldest = self.calls[len(self.calls) - allowed] if allowed > 0 else now
+                    raise RateLimited(max(oldest + API_BUDGET_PERIOD - now, 1))
+
+                self.calls.append(now)
+                self.stats['calls'] += 1
+                return
+
+    def expire(self, now):
+        while self.calls and self.calls[0] <= now - API_BUDGET_PERIOD:
+            self.calls.popleft()
+        if now - self.budget_time >= API_BUDGET_PERIOD:
+            self.budget = min(self.budget * API_BUDGET_GROWTH, self.max_budget)
+            self.budget_time = now
+
+    def rate_limited(self, duration):
+        with self.condition:
+            now = time()
+            logging.warning('API rate limit reached after ' + str(len(self.calls)) + ' calls, blocked for ' +
+                            str(duration) + ' s')
+            self.stats['rate_limited'] += 1
+            self.blocked_until = max(self.blocked_until, now + duration)
+            self.budget = max(min(self.budget, len(self.calls)), API_MIN_BUDGET)
+            self.budget_time = now
+
+    def get_stats(self):
+        with self.condition:
+            self.expire(time())
+            return dict(self.stats, window=len(self.calls), budget=int(self.budget))
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+Measures the request handlers the kernel calls most, as notebook size grows.
+
+Each operation is called directly on an unmounted EvernoteFuse for DURATION seconds, or at most
+MAX_OPS times, with replies captured instead of sent. Results go to stdout and, as JSON with
+the commit they were measured on, to the --output file, so runs on two commits can be compared.
+
+Run from the repository root (config.py must exist):
+
+    python3 -m benchmarks.bench_handlers [--sizes 1000,10000,100000] [--output bench_handlers.json]
+"""
+from __future__ import print_function, absolute_import, division
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+from timeit import default_timer
+
+import fusepass
+from benchmarks.harness import Replies, make_fuse
+
+NOTEBOOK_SIZES = (1000, 10000, 100000)
+CONTENT_SIZE = 4096  # bytes of every note
+DURATION = 1.0  # seconds per operation and notebook size
+MAX_OPS = 100000
+UNLINK_FILES = 10000  # files created before the unlink run, it ends when they are all removed
+WRITE_NOTES = 1000  # notes written to, each written note keeps a copy of its content in memory
+CHUNK_SIZE = 4096  # bytes per read, write and readdir call
+
+
+class HandlerBench(object):
+
+    def __init__(self, notes_count):
+        self.notes_count = notes_count
+        self.fs, self.notebook_ino = make_fuse(notes_count, b'x' * CONTENT_SIZE)
+        self.replies = Replies(self.fs)
+        self.note_inos = [self.fs.note_guid_ino['note-%d' % i] for i in range(notes_count)]
+        self.unlink_names = []
+        self.random = random.Random(0)
+
+    def call(self, handler, *args):
+        """
+        :return: (kind, args) of the reply
+        """
+        req = self.replies.next_request()
+        handler(req, *args)
+        reply = self.replies.pop(req)
+        if reply[0] == 'err' and reply[1][0] != 0:
+            raise AssertionError(handler.__name__ + ' failed: ' + os.strerror(reply[1][0]))
+        return reply
+
+    def random_ino(self):
+        return self.note_inos[self.random.randrange(self.notes_count)]
+
+    def lookup(self, i):
+        self.call(self.fs.lookup, self.notebook_ino, 'note %d' % self.random.randrange(self.notes_count))
+
+    def getattr(self, i):
+        self.call(self.fs.getattr, self.random_ino(), None)
+
+    def readdir(self, i):
+        # a whole listing, as 'ls' reads it
+        fi = dict(flags=os.O_RDONLY)
+        self.call(self.fs.opendir, self.notebook_ino, fi)
+        off = 0
+        while True:
+            kind, (buf, size) = self.call(self.fs.readdir, self.notebook_ino, CHUNK_SIZE, off, fi)
+            if not size:
+                break
+            off += size
+        self.call(self.fs.releasedir, self.notebook_ino, fi)
+
+    def open(self, i):
+        self.call(self.fs.open, self.random_ino(), dict(flags=os.O_RDONLY))
+
+    def read(self, i):
+        self.call(self.fs.read, self.random_ino(), CHUNK_SIZE, 0, dict(flags=os.O_RDONLY))
+
+    def write(self, i):
+        ino = self.note_inos[self.random.randrange(min(WRITE_NOTES, self.notes_count))]
+        self.call(self.fs.write, ino, b'y' * CHUNK_SIZE, 0, dict(flags=os.O_WRONLY))
+
+    def rename(self, i):
+        # renames a note and back on the next call
+        names = ('note %d' % (i // 2 % self.notes_count), 'renamed %d' % (i // 2 % self.notes_count))
+        if i % 2:
+            names = names[::-1]
+        self.call(self.fs.rename, self.notebook_ino, names[0], self.notebook_ino, names[1])
+
+    def prepare_unlink(self):
+        self.unlink_names = ['unlink %d' % i for i in range(UNLINK_FILES)]
+        for name in self.unlink_names:
+            self.call(self.fs.mknod, self.notebook_ino, name, 0o100664, 0)
+
+    def unlink(self, i):
+        self.call(self.fs.unlink, self.notebook_ino, self.unlink_names[i])
+
+    def run(self, name):
+        """
+        :return: dict of ops, ops_per_sec, p50_us and p99_us
+        """
+        if name == 'unlink':
+            self.prepare_unlink()
+            max_ops = len(self.unlink_names)
+        elif name == 'rename':
+            max_ops = MAX_OPS // 2 * 2  # an even count leaves every note with its name
+        else:
+            max_ops = MAX_OPS
+        op = getattr(self, name)
+
+        latencies = []
+        started = default_timer()
+        deadline = started + DURATION
+        now = started
+        while len(latencies) < max_ops and now < deadline:
+            op(len(latencies))
+            finished = default_timer()
+            latencies.append(finished - now)
+            now = finished
+        if name == 'rename' and len(latencies) % 2:
+            op(len(latencies))
+        elapsed = now - started
+
+        latencies.sort()
+        return dict(
+            ops=len(latencies),
+            ops_per_sec=len(latencies) / elapsed,
+            p50_us=latencies[len(latencies) * 50 // 100] * 1e6,
+            p99_us=latencies[len(latencies) * 99 // 100] * 1e6)
+
+
+OPERATIONS = ('lookup', 'getattr', 'readdir', 'open', 'read', 'write', 'rename', 'unlink')
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks EvernoteFuse request handlers without a mount')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in NOTEBOOK_SIZES),
+                        help='comma separated notebook sizes')
+    parser.add_argument('--output', default='bench_handlers.json', help='JSON file the results are written to')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    commit = get_commit()
+
+    os.chdir(tempfile.mkdtemp())
+    # keep uploads from starting while the benchmark runs
+    fusepass.NOTE_CREATION_DELAY = fusepass.NOTE_UPDATE_DELAY = 3600
+
+    results = []
+    print('%-8s %8s %12s %10s %10s' % ('op', 'notes', 'ops/s', 'p50 us', 'p99 us'))
+    for notes_count in [int(size) for size in args.sizes.split(',')]:
+        bench = HandlerBench(notes_count)
+        for name in OPERATIONS:
+            result = dict(bench.run(name), op=name, notes=notes_count)
+            results.append(result)
+            print('%-8s %8d %12.0f %10.1f %10.1f' % (
+                name, notes_count, result['ops_per_sec'], result['p50_us'], result['p99_us']))
+        bench.fs.destroy(None)
+
+    with open(output, 'w') as f:
+        json.dump(dict(commit=commit, python=platform.python_version(), content_size=CONTENT_SIZE,
+                       results=results), f, indent=2, sort_keys=True)
+    print('results written to ' + output)
+
+
+if __name__ == '__main__':
+    main()
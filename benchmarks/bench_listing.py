@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Measures listing a notebook from a simulated note store with network latency and bandwidth.
+
+'findNotes' fetches as the previous listing did, full notes in pages of 100; they were applied to
+the tree once all of them arrived, its time leaves that out. 'metadata' is sync_notebook_notes, findNotesMetadata pages of
+config.NOTES_PAGE_SIZE, its time includes applying every page to the tree. 'first' is when
+the first listed note shows up in the tree.
+
+Run from the repository root (config.py must exist):
+
+    python3 -m benchmarks.bench_listing
+"""
+from __future__ import print_function, absolute_import, division
+
+import os
+import tempfile
+from timeit import default_timer
+
+from evernote.edam.notestore.ttypes import NoteFilter
+
+from benchmarks.harness import make_fuse
+from simulated_note_store import SimulatedNoteStore
+
+NOTEBOOK_SIZES = (1000, 10000)
+LATENCY = 0.05  # seconds per call
+BANDWIDTH = 4 * 1024 * 1024  # bytes per second
+LEGACY_BATCH_SIZE = 100
+
+
+def list_legacy(note_store, notebook_guid):
+    # the previous sync_notebook_notes paging, kept for comparison
+    note_filter = NoteFilter()
+    note_filter.notebookGuid = notebook_guid
+    note_list = []
+    current_offset = 0
+    while True:
+        note_batch = note_store.findNotes(note_filter, current_offset, LEGACY_BATCH_SIZE + 1)
+        if len(note_batch.notes) < LEGACY_BATCH_SIZE + 1:
+            note_list += note_batch.notes
+            break
+        else:
+            note_list += note_batch.notes[:-1]
+            current_offset += LEGACY_BATCH_SIZE
+    return note_list
+
+
+def report(name, notes_count, note_store, elapsed, first):
+    stats = note_store.get_stats()
+    print('%-10s %8d notes %5d calls %10.1f KB %8.2f s, first %6.2f s' % (
+        name, notes_count, stats['calls'], stats['transferred'] / 1024, elapsed, first))
+
+
+def make_note_store(notes_count):
+    return SimulatedNoteStore(
+        notebooks=1, notes_per_notebook=notes_count, latency=LATENCY, bandwidth=BANDWIDTH)
+
+
+def main():
+    os.chdir(tempfile.mkdtemp())
+
+    for notes_count in NOTEBOOK_SIZES:
+        note_store = make_note_store(notes_count)
+        notebook = list(note_store.notebooks.values())[0]
+        started = default_timer()
+        list_legacy(note_store, notebook.guid)
+        elapsed = default_timer() - started
+        report('findNotes', notes_count, note_store, elapsed, elapsed)
+
+        note_store = make_note_store(notes_count)
+        fs, notebook_ino = make_fuse(0)
+        fs.api.note_store = note_store
+        fs.notebooks[notebook.guid] = notebook
+        fs.add_notebook_to_fuse(notebook.guid)
+        first = []
+        apply_listed_note = fs.apply_listed_note
+
+        def apply_first(notebook, metadata):
+            if not first:
+                first.append(default_timer())
+            apply_listed_note(notebook, metadata)
+        fs.apply_listed_note = apply_first
+
+        started = default_timer()
+        fs.sync_notebook_notes(notebook)
+        elapsed = default_timer() - started
+        report('metadata', notes_count, note_store, elapsed, first[0] - started)
+        assert len(fs.notebook_notes[notebook.guid]) == notes_count
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Measures per-operation cost of the write/open lookup paths as notebook size grows.
+
+Run from the repository root (config.py must exist):
+
+    python3 -m benchmarks.bench_lookups
+"""
+from __future__ import print_function, absolute_import, division
+
+import os
+import tempfile
+from timeit import default_timer
+
+from benchmarks.harness import make_fuse
+
+NOTEBOOK_SIZES = (1000, 10000, 40000)
+OPS = 2000
+
+
+def bench(name, notes_count, fn):
+    started = default_timer()
+    for i in range(OPS):
+        fn(i)
+    elapsed = default_timer() - started
+    print('%-12s %8d notes %10.2f us/op' % (name, notes_count, elapsed / OPS * 1e6))
+
+
+def main():
+    os.chdir(tempfile.mkdtemp())
+
+    for notes_count in NOTEBOOK_SIZES:
+        fs, notebook_ino = make_fuse(notes_count)
+        fs.reply_write = lambda req, count: None
+        fs.reply_open = lambda req, fi: None
+        last_ino = fs.note_guid_ino['note-%d' % (notes_count - 1)]
+        tmp_ino = fs.create_ino()
+        fs.attr[tmp_ino] = dict(st_ino=tmp_ino, st_mode=0o100664, st_nlink=1, st_size=0)
+        fs.parent[tmp_ino] = notebook_ino
+        fs.add_child(notebook_ino, '.tmp', tmp_ino)
+
+        bench('write', notes_count, lambda i: fs.write(None, tmp_ino, b'x', 0, {}))
+        bench('open', notes_count, lambda i: fs.open(None, last_ino, {'flags': os.O_RDONLY}))
+        bench('name', notes_count, lambda i: fs.find_child_by_parent_and_ino(notebook_ino, last_ino))
+        bench('title', notes_count, lambda i: fs.find_note_by_name('notebook', 'note %d' % i))
+        bench('guid', notes_count, lambda i: fs.get_note_ino('note-%d' % i))
+
+
+if __name__ == '__main__':
+    main()
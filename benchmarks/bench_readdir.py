@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Measures a full directory listing, as the kernel reads it in 4K chunks, as notebook size grows.
+
+'cached' packs the entries once per listing, 'legacy' is the previous reply_readdir that packed
+all entries again for every chunk.
+
+Run from the repository root (config.py must exist):
+
+    python3 -m benchmarks.bench_readdir
+"""
+from __future__ import print_function, absolute_import, division
+
+import ctypes
+import os
+import tempfile
+from timeit import default_timer
+
+from benchmarks.harness import make_fuse
+from lib.fusell import LibFUSE, c_stat
+
+NOTEBOOK_SIZES = (1000, 10000, 100000)
+LEGACY_MAX_SIZE = 10000  # quadratic, larger notebooks take minutes
+CHUNK_SIZE = 4096
+
+
+def legacy_reply_readdir(fs, req, size, off, entries):
+    # the previous reply_readdir implementation, kept for comparison
+    bufsize = 0
+    sized_entries = []
+    for name, attr in entries:
+        name = name.encode(fs.encoding)
+        entsize = fs.libfuse.fuse_add_direntry(req, None, 0, name, None, 0)
+        sized_entries.append((name, attr, entsize))
+        bufsize += entsize
+
+    next = 0
+    buf = ctypes.create_string_buffer(bufsize)
+    for name, attr, entsize in sized_entries:
+        entbuf = ctypes.cast(
+            ctypes.addressof(buf) + next, ctypes.c_char_p)
+        st = c_stat(**attr)
+        next += entsize
+        fs.libfuse.fuse_add_direntry(
+            req, entbuf, entsize, name, ctypes.byref(st), next)
+
+    return min(max(bufsize - off, 0), size)
+
+
+def list_cached(fs, ino):
+    fi = {}
+    fs.opendir(None, ino, fi)
+    off = 0
+    while True:
+        fs.readdir(None, ino, CHUNK_SIZE, off, fi)
+        if not fs.replied:
+            break
+        off += fs.replied
+    fs.releasedir(None, ino, fi)
+    return off
+
+
+def list_legacy(fs, ino):
+    off = 0
+    while True:
+        entries = [(name, attr) for name, child, attr in fs.list_directory(ino)]
+        replied = legacy_reply_readdir(fs, None, CHUNK_SIZE, off, entries)
+        if not replied:
+            break
+        off += replied
+    return off
+
+
+def report(name, notes_count, listed, elapsed):
+    print('%-8s %8d notes %10.1f ms %8d bytes' % (name, notes_count, elapsed * 1000, listed))
+
+
+def main():
+    os.chdir(tempfile.mkdtemp())
+
+    for notes_count in NOTEBOOK_SIZES:
+        fs, notebook_ino = make_fuse(notes_count)
+        fs.encoding = 'utf-8'
+        fs.libfuse = LibFUSE()
+        fs.libfuse.fuse_reply_buf = lambda req, buf, size: setattr(fs, 'replied', size)
+        fs.reply_open = lambda req, fi: None
+        fs.reply_err = lambda req, err: None
+
+        started = default_timer()
+        listed = list_cached(fs, notebook_ino)
+        report('cached', notes_count, listed, default_timer() - started)
+
+        if notes_count <= LEGACY_MAX_SIZE:
+            started = default_timer()
+            listed = list_legacy(fs, notebook_ino)
+            report('legacy', notes_count, listed, default_timer() - started)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Measures how long a restart takes until the first listing, with the notes of the previous mount
+stored in the metadata store.
+
+'init' is building EvernoteFuse and init(), 'ls /' then lists the root and 'ls notebook' looks
+up and lists one notebook. With config.LAZY_TREE the notes of a notebook are loaded on its first
+lookup or listing, so 'init' and 'ls /' do not depend on the number of notes. They are read from
+the snapshot the previous unmount wrote, or unpickled from the metadata store when there is none.
+'tree' is the number of inodes in memory after the listings.
+
+Run from the repository root (config.py must exist):
+
+    python3 -m benchmarks.bench_startup [--sizes 10000,100000]
+"""
+from __future__ import print_function, absolute_import, division
+
+import argparse
+import gc
+import os
+import tempfile
+from time import time
+from timeit import default_timer
+
+from evernote.edam.type.ttypes import Note, Notebook
+
+import config
+import fusepass
+from benchmarks.harness import Replies, build_fuse
+from metadata_store import MetadataStore
+from simulated_note_store import SimulatedNoteStore
+
+NOTES_COUNTS = (10000, 100000)
+NOTEBOOKS = 10
+REPEAT = 3  # restarts per setting, the fastest is reported
+UPDATE_COUNT = 1
+CHUNK_SIZE = 4096
+
+
+def store_account(notes_count):
+    """
+    writes the state a mount of an account with notes_count notes leaves behind
+    """
+    store = MetadataStore(fusepass.EVERNOTE_DB_FILE)
+    now = time()
+    ino = 1
+    with store.transaction():
+        for i in range(NOTEBOOKS):
+            ino += 1
+            store.put_notebook(Notebook(guid='notebook-%d' % i, name='notebook %d' % i), ino)
+            store.set_notebook_notes_sync_time('notebook-%d' % i, now)
+        for i in range(notes_count):
+            ino += 1
+            store.put_note(Note(
+                guid='note-%d' % i, title='note %d' % i, notebookGuid='notebook-%d' % (i % NOTEBOOKS),
+                created=int(now * 1000), updated=int(now * 1000), contentLength=2048, updateSequenceNum=i,
+                active=True), ino)
+        # nothing changed since, so restarts do not sync
+        store.set_state('update_count', UPDATE_COUNT)
+        store.set_state('notebooks_sync_time', now)
+        store.set_state('changes_sync_time', int(now * 1000))
+    store.close()
+
+
+def list_directory(fs, replies, ino):
+    def call(handler, *args):
+        req = replies.next_request()
+        handler(req, *args)
+        return replies.pop(req)
+
+    fi = dict(flags=os.O_RDONLY)
+    call(fs.opendir, ino, fi)
+    off = 0
+    while True:
+        kind, (buf, size) = call(fs.readdir, ino, CHUNK_SIZE, off, fi)
+        if not size:
+            break
+        off += size
+    call(fs.releasedir, ino, fi)
+
+
+def restart(snapshot):
+    """
+    :param snapshot: False to remove the snapshot before restarting
+    :return: dict of init, ls_root and ls_notebook seconds and the tree size
+    """
+    if not snapshot and os.path.exists(fusepass.EVERNOTE_SNAPSHOT_FILE):
+        os.remove(fusepass.EVERNOTE_SNAPSHOT_FILE)
+    note_store = SimulatedNoteStore(notebooks=0)
+    note_store.update_count = UPDATE_COUNT
+    # garbage of the previous restart is not counted
+    gc.collect()
+
+    started = default_timer()
+    fs = build_fuse(note_store)
+    replies = Replies(fs)
+    fs.init(None, None)
+    initialised = default_timer()
+    list_directory(fs, replies, fs.root_ino)
+    listed = default_timer()
+
+    req = replies.next_request()
+    fs.lookup(req, fs.root_ino, 'notebook 0')
+    replies.pop(req)
+    notebook_ino = fs.children[fs.root_ino]['notebook 0']
+    list_directory(fs, replies, notebook_ino)
+    finished = default_timer()
+
+    result = dict(
+        init=initialised - started, ls_root=listed - initialised, ls_notebook=finished - listed, tree=len(fs.attr))
+    fs.destroy(None)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks EvernoteFuse restarts until the first listing')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in NOTES_COUNTS),
+                        help='comma separated notes counts')
+    args = parser.parse_args()
+
+    # listings would prefetch notes the simulated store does not have
+    config.PREFETCH_NOTEBOOK_BUDGET = 0
+
+    print('%-6s %-9s %8s %10s %10s %14s %8s' % (
+        'lazy', 'snapshot', 'notes', 'init ms', 'ls / ms', 'ls notebook ms', 'tree'))
+    for notes_count in [int(size) for size in args.sizes.split(',')]:
+        os.chdir(tempfile.mkdtemp())
+        store_account(notes_count)
+        for lazy in (False, True):
+            for snapshot in (False, True):
+                config.LAZY_TREE = lazy
+                if snapshot:
+                    # unmounting writes the snapshot the next restarts read
+                    restart(snapshot)
+                results = [restart(snapshot) for i in range(REPEAT)]
+                best = dict((key, min(result[key] for result in results)) for key in results[0])
+                print('%-6s %-9s %8d %10.1f %10.1f %14.1f %8d' % (
+                    lazy, snapshot, notes_count, best['init'] * 1000, best['ls_root'] * 1000,
+                    best['ls_notebook'] * 1000, best['tree']))
+
+
+if __name__ == '__main__':
+    main()
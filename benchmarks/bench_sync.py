@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Counts the note store calls of the incremental sync after a change made from another client.
+
+Each change is followed by SYNCS calls of sync_changes. The first one pulls the change, the
+following ones must find nothing and cost a single getSyncState call, also after a change that
+the filtered sync chunks do not return, such as a renamed tag.
+
+Run from the repository root (config.py must exist):
+
+    python3 -m benchmarks.bench_sync
+"""
+from __future__ import print_function, absolute_import, division
+
+import os
+import tempfile
+from timeit import default_timer
+
+from benchmarks.harness import make_fuse
+from simulated_note_store import SimulatedNoteStore
+
+NOTES = 100
+SYNCS = 3
+LATENCY = 0.05  # seconds per call
+
+
+def count_calls(note_store, fn):
+    before = dict(note_store.get_stats()['methods'])
+    started = default_timer()
+    fn()
+    elapsed = default_timer() - started
+    after = note_store.get_stats()['methods']
+    return dict((name, after[name] - before.get(name, 0)) for name in after if after[name] != before.get(name, 0)), elapsed
+
+
+def main():
+    os.chdir(tempfile.mkdtemp())
+
+    note_store = SimulatedNoteStore(notebooks=1, notes_per_notebook=NOTES, latency=LATENCY)
+    note = list(note_store.notes.values())[0]
+    fs, notebook_ino = make_fuse(0)
+    fs.api.note_store = note_store
+    # only sync_changes calls the note store, listings it schedules are left out
+    fs.sync_scheduler.stop()
+    fs.sync_changes()
+
+    changes = (
+        ('none', lambda: None),
+        ('note edited', lambda: note_store.edit_note(note.guid, 'edited')),
+        ('tag renamed', note_store.change_tag),
+    )
+    for name, change in changes:
+        change()
+        for i in range(SYNCS):
+            calls, elapsed = count_calls(note_store, fs.sync_changes)
+            print('%-12s sync %d %8.2f s  %s' % (name, i + 1, elapsed, ', '.join(
+                '%s=%d' % item for item in sorted(calls.items()))))
+        assert calls == dict(getSyncState=1), name + ': a sync after the change was pulled made ' + str(calls)
+        assert fs.update_count == note_store.update_count
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Measures write() throughput for large sequential and random writes into one note.
+
+Run from the repository root (config.py must exist):
+
+    python3 -m benchmarks.bench_write
+"""
+from __future__ import print_function, absolute_import, division
+
+import os
+import random
+import tempfile
+from timeit import default_timer
+
+from benchmarks.harness import make_fuse
+
+NOTE_SIZE = 5 * 1024 * 1024
+CHUNK_SIZES = (4096, 128 * 1024)
+
+
+def concat_write(data, buf, off):
+    # the previous write() implementation, kept for comparison
+    return data[:off] + buf
+
+
+def report(name, chunk_size, written, elapsed):
+    print('%-12s %7d B chunks %10.1f MB/s' % (name, chunk_size, written / elapsed / 1024 / 1024))
+
+
+def main():
+    os.chdir(tempfile.mkdtemp())
+    fs, notebook_ino = make_fuse(0)
+    fs.reply_write = lambda req, count: None
+
+    for chunk_size in CHUNK_SIZES:
+        chunk = b'x' * chunk_size
+        offsets = list(range(0, NOTE_SIZE, chunk_size))
+
+        ino = fs.create_ino()
+        fs.attr[ino] = dict(st_ino=ino, st_mode=0o100664, st_nlink=1, st_size=0)
+        fs.parent[ino] = notebook_ino
+        fs.add_child(notebook_ino, '.sequential-%d' % chunk_size, ino)
+
+        started = default_timer()
+        for off in offsets:
+            fs.write(None, ino, chunk, off, {})
+        report('sequential', chunk_size, NOTE_SIZE, default_timer() - started)
+
+        random.shuffle(offsets)
+        started = default_timer()
+        for off in offsets:
+            fs.write(None, ino, chunk, off, {})
+        report('random', chunk_size, NOTE_SIZE, default_timer() - started)
+
+        data = b''
+        started = default_timer()
+        for off in range(0, NOTE_SIZE, chunk_size):
+            data = concat_write(data, chunk, off)
+        report('concat', chunk_size, NOTE_SIZE, default_timer() - started)
+
+
+if __name__ == '__main__':
+    main()
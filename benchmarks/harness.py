@@ -0,0 +1,86 @@
+"""
+Builds EvernoteFuse without mounting anything, for benchmarks that call its request handlers directly.
+"""
+from __future__ import print_function, absolute_import, division
+
+from itertools import count
+import os
+from time import time
+
+from evernote.edam.type.ttypes import Note, Notebook
+
+import fusepass
+from lib.fusell import FUSELL, LibFUSE
+from simulated_note_store import SimulatedEvernoteClient, SimulatedNoteStore
+
+SYNCED_UNTIL = time() + 365 * 24 * 60 * 60  # keeps notes fresh for the whole run, without any sync
+
+
+def build_fuse(note_store):
+    """
+    :return: EvernoteFuse on note_store, neither mounted nor initialised
+    """
+    FUSELL.__init__ = lambda self, mount_point, *args, **kwargs: None
+    return fusepass.EvernoteFuse('', SimulatedEvernoteClient(note_store))
+
+
+def make_fuse(notes_count, content=b''):
+    """
+    builds the filesystem state of one notebook without mounting anything or calling the note store
+
+    :param content: content of every note, stored once in the content segment
+    :return: (fs, notebook_ino)
+    """
+    fs = build_fuse(SimulatedNoteStore(notebooks=0))
+    # the notes are not in the note store, changes the benchmarks make are dropped instead of uploaded
+    fs.upload_queue.upload = lambda ino, kinds: None
+
+    fs.attr[fs.root_ino] = dict(st_ino=fs.root_ino, st_mode=fusepass.S_IFDIR | 0o777, st_nlink=2)
+    fs.parent[fs.root_ino] = fs.root_ino
+    notebook = Notebook(guid='notebook', name='notebook')
+    fs.notebooks[notebook.guid] = notebook
+    fs.add_notebook_to_fuse(notebook.guid)
+    fs.notebooks_notes_sync_time[notebook.guid] = SYNCED_UNTIL
+
+    location = (fs.contents.append(content), len(content))
+    # all notes share one copy of the content, none of them may be evicted
+    fs.content_cache.limit = max(fs.content_cache.limit, (notes_count + 1) * len(content))
+    for i in range(notes_count):
+        fs.add_notebook_note_to_fuse(Note(
+            guid='note-%d' % i, title='note %d' % i, notebookGuid=notebook.guid, contentLength=len(content)))
+        fs.note_sync_time['note-%d' % i] = SYNCED_UNTIL
+        fs.cache_content('note-%d' % i, location)
+    return fs, fs.notebook_ino[notebook.guid]
+
+
+class Replies(object):
+
+    def __init__(self, fs):
+        """
+        Captures what handlers reply, in place of the libfuse fuse_reply_* functions.
+
+        Handlers still build the ctypes structures they pass to libfuse, so that cost is measured,
+        only the calls into libfuse are replaced. Requests are numbers from next_request().
+        """
+        self.requests = count(1)
+        self.replies = {}
+        fs.encoding = 'utf-8'
+        fs.libfuse = LibFUSE()
+        fs.req_ctx = lambda req: dict(uid=os.getuid(), gid=os.getgid(), pid=os.getpid(), umask=0o022)
+        for name in ('err', 'entry', 'attr', 'open', 'write', 'buf', 'none'):
+            setattr(fs.libfuse, 'fuse_reply_' + name, self.capture(name))
+
+    def capture(self, kind):
+        def reply(req, *args):
+            self.replies[req] = (kind, args)
+            return 0
+        return reply
+
+    def next_request(self):
+        return next(self.requests)
+
+    def pop(self, req):
+        """
+        :return: (kind, args) of the reply to req, kind being the fuse_reply_* suffix
+        """
+        return self.replies.pop(req)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+Load test of a mounted EvernoteFuse, backed by a simulated note store.
+
+The filesystem is mounted on a temporary directory by a child process, then worker processes
+run each workload against the mount, through the kernel as any program would:
+
+    find    every worker lists every directory and stats every file
+    cat     the notes are split between the workers, each reads its notes whole
+    save    editor-style saves: write a hidden temporary file, fsync it and rename it over the note
+    create  every worker creates new notes
+
+For each workload it reports throughput, p50/p99 latency per operation and the note store
+calls made while it ran, uploads included. Saves must leave the number of notes unchanged, a
+save creating a note instead of updating it is reported as an error. It is skipped when FUSE
+can not be mounted here.
+
+Run from the repository root (config.py must exist):
+
+    python3 -m benchmarks.load_mounted [--workers 4] [--notebooks 5] [--notes 200] [--latency 0.05]
+"""
+from __future__ import print_function, absolute_import, division
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from multiprocessing import Pipe, Pool, Process
+from stat import S_ISDIR
+from threading import Thread
+from time import sleep
+from timeit import default_timer
+
+WORKLOADS = ('find', 'cat', 'save', 'create')
+MOUNT_TIMEOUT = 30.0  # seconds
+SETTLE_TIME = 3.0  # seconds to wait after writes, so that their uploads are counted
+SAVES_PER_WORKER = 50
+CREATES_PER_WORKER = 50
+NOTE_TEXT = b'edited by the load test ' * 40
+
+
+def check_fuse():
+    """
+    :return: why FUSE can not be mounted here, None if it can
+    """
+    if not os.path.exists('/dev/fuse') or not os.access('/dev/fuse', os.R_OK | os.W_OK):
+        return '/dev/fuse is not available'
+    if not shutil.which('fusermount'):
+        return 'fusermount is not installed'
+    try:
+        import lib.fusell
+    except EnvironmentError as e:
+        return str(e)
+    return None
+
+
+def answer_stats(note_store, conn):
+    while True:
+        try:
+            conn.recv()
+        except EOFError:
+            return
+        conn.send(note_store.get_stats())
+
+
+def serve(mount_point, state_dir, store_settings, conn):
+    # runs in the child process until the filesystem is unmounted
+    import fusepass
+    from simulated_note_store import SimulatedEvernoteClient, SimulatedNoteStore
+
+    os.chdir(state_dir)
+    # notes created by a save would otherwise be uploaded after SETTLE_TIME, and not be seen
+    fusepass.NOTE_CREATION_DELAY = SETTLE_TIME / 3
+    note_store = SimulatedNoteStore(**store_settings)
+    thread = Thread(target=answer_stats, args=(note_store, conn))
+    thread.daemon = True
+    thread.start()
+    fusepass.EvernoteFuse(mount_point, SimulatedEvernoteClient(note_store))
+
+
+def timed(latencies, fn, *args):
+    started = default_timer()
+    result = fn(*args)
+    latencies.append(default_timer() - started)
+    return result
+
+
+def run_find(mount_point, index, workers, files):
+    latencies = []
+    directories = [mount_point]
+    while directories:
+        directory = directories.pop()
+        for name in timed(latencies, os.listdir, directory):
+            path = os.path.join(directory, name)
+            if S_ISDIR(timed(latencies, os.lstat, path).st_mode):
+                directories.append(path)
+    return latencies
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def run_cat(mount_point, index, workers, files):
+    latencies = []
+    for path in files[index::workers]:
+        timed(latencies, read_file, path)
+    return latencies
+
+
+def save_file(path):
+    directory, name = os.path.split(path)
+    temp_path = os.path.join(directory, '.' + name + '.swp')
+    with open(temp_path, 'wb') as f:
+        f.write(NOTE_TEXT)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, path)
+
+
+def run_save(mount_point, index, workers, files):
+    latencies = []
+    for path in files[index::workers][:SAVES_PER_WORKER]:
+        timed(latencies, save_file, path)
+    return latencies
+
+
+def create_file(path):
+    with open(path, 'wb') as f:
+        f.write(NOTE_TEXT)
+
+
+def run_create(mount_point, index, workers, files):
+    latencies = []
+    notebooks = sorted(os.listdir(mount_point))
+    for i in range(CREATES_PER_WORKER):
+        path = os.path.join(mount_point, notebooks[i % len(notebooks)], 'load %d-%d' % (index, i))
+        timed(latencies, create_file, path)
+    return latencies
+
+
+def run_worker(args):
+    workload, mount_point, index, workers, files = args
+    try:
+        return globals()['run_' + workload](mount_point, index, workers, files), None
+    except Exception as e:
+        return [], repr(e)
+
+
+def list_files(mount_point):
+    files = []
+    for directory, directories, names in os.walk(mount_point):
+        files += [os.path.join(directory, name) for name in names if not name.startswith('.')]
+    return sorted(files)
+
+
+def count_calls(before, after):
+    methods = after['methods']
+    return dict((method, calls - before['methods'].get(method, 0)) for method, calls in methods.items()
+                if calls != before['methods'].get(method, 0))
+
+
+def run_workload(pool, workload, mount_point, workers, get_stats):
+    files = list_files(mount_point) if workload in ('cat', 'save') else []
+    before = get_stats()
+    started = default_timer()
+    results = pool.map(run_worker, [(workload, mount_point, i, workers, files) for i in range(workers)])
+    elapsed = default_timer() - started
+    if workload in ('save', 'create'):
+        sleep(SETTLE_TIME)
+    after = get_stats()
+    calls = count_calls(before, after)
+
+    latencies = sorted(latency for worker_latencies, error in results for latency in worker_latencies)
+    errors = [error for worker_latencies, error in results if error]
+    if workload == 'save' and after['notes'] != before['notes']:
+        errors.append('saves changed the number of notes from %d to %d' % (before['notes'], after['notes']))
+    return dict(
+        workload=workload,
+        ops=len(latencies),
+        ops_per_sec=len(latencies) / elapsed if elapsed else 0.0,
+        p50_ms=latencies[len(latencies) * 50 // 100] * 1000 if latencies else 0.0,
+        p99_ms=latencies[len(latencies) * 99 // 100] * 1000 if latencies else 0.0,
+        errors=errors,
+        api_calls=calls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of a mounted EvernoteFuse')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes')
+    parser.add_argument('--notebooks', type=int, default=5)
+    parser.add_argument('--notes', type=int, default=200, help='notes per notebook')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per note store call')
+    parser.add_argument('--bandwidth', type=int, default=None, help='bytes per second')
+    parser.add_argument('--workloads', default=','.join(WORKLOADS))
+    parser.add_argument('--output', default=None, help='JSON file the results are written to')
+    args = parser.parse_args()
+
+    reason = check_fuse()
+    if reason is not None:
+        print('skipped: ' + reason)
+        return 0
+
+    state_dir = tempfile.mkdtemp()
+    mount_point = tempfile.mkdtemp()
+    store_settings = dict(
+        notebooks=args.notebooks, notes_per_notebook=args.notes, latency=args.latency, bandwidth=args.bandwidth)
+    conn, child_conn = Pipe()
+    server = Process(target=serve, args=(mount_point, state_dir, store_settings, child_conn))
+    server.start()
+
+    def get_stats():
+        conn.send(None)
+        return conn.recv()
+
+    deadline = default_timer() + MOUNT_TIMEOUT
+    while not os.path.ismount(mount_point):
+        if not server.is_alive() or default_timer() > deadline:
+            print('failed to mount ' + mount_point)
+            server.terminate()
+            return 1
+        sleep(0.1)
+
+    results = []
+    try:
+        pool = Pool(args.workers)
+        print('%-8s %8s %10s %10s %10s %7s  %s' % ('workload', 'ops', 'ops/s', 'p50 ms', 'p99 ms', 'errors', 'api calls'))
+        for workload in args.workloads.split(','):
+            result = run_workload(pool, workload, mount_point, args.workers, get_stats)
+            results.append(result)
+            print('%-8s %8d %10.1f %10.2f %10.2f %7d  %s' % (
+                workload, result['ops'], result['ops_per_sec'], result['p50_ms'], result['p99_ms'],
+                len(result['errors']), ' '.join('%s=%d' % call for call in sorted(result['api_calls'].items()))))
+            for error in result['errors'][:3]:
+                print('  error: ' + error)
+        pool.close()
+        pool.join()
+    finally:
+        subprocess.call(['fusermount', '-u', mount_point])
+        server.join(MOUNT_TIMEOUT)
+        if server.is_alive():
+            server.terminate()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(settings=vars(args), results=results), f, indent=2, sort_keys=True)
+    return 1 if any(result['errors'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
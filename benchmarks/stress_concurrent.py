@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Stress test for concurrent request handlers, as they run with FUSE_MULTITHREADED.
+
+Worker threads call getattr/lookup/read/write on the same notebook the way
+fuse_session_loop_mt dispatches them, then the resulting state is checked:
+every thread owns one region of a shared file, reads must never see a torn
+region and the final contents and sizes must match what was written.
+
+Run from the repository root (config.py must exist):
+
+    python3 -m benchmarks.stress_concurrent
+"""
+from __future__ import print_function, absolute_import, division
+
+import os
+import random
+import sys
+import tempfile
+from threading import Thread
+from timeit import default_timer
+
+import fusepass
+from benchmarks.harness import make_fuse
+
+THREADS = 8
+NOTES = 1000
+DURATION = 5.0  # seconds
+REGION_SIZE = 4096
+
+
+def add_file(fs, notebook_ino, name):
+    ino = fs.create_ino()
+    fs.attr[ino] = dict(st_ino=ino, st_mode=0o100664, st_nlink=1, st_size=0)
+    fs.parent[ino] = notebook_ino
+    fs.add_child(notebook_ino, name, ino)
+    return ino
+
+
+def check_regions(data, errors):
+    for off in range(0, len(data), REGION_SIZE):
+        region = data[off:off + REGION_SIZE]
+        if region.count(region[:1]) != len(region):
+            errors.append('torn region at ' + str(off))
+
+
+def worker(fs, index, notebook_ino, shared_ino, own_ino, counts, errors):
+    # pattern of this thread, written to its own region of the shared file
+    pattern = bytes([ord('A') + index]) * REGION_SIZE
+    note_inos = list(fs.notes_ino)
+    ops = 0
+    deadline = default_timer() + DURATION
+    try:
+        while default_timer() < deadline:
+            op = random.randrange(5)
+            if op == 0:
+                fs.getattr(None, random.choice(note_inos), None)
+            elif op == 1:
+                fs.lookup(None, notebook_ino, 'note %d' % random.randrange(NOTES))
+            elif op == 2:
+                fs.write(None, shared_ino, pattern, index * REGION_SIZE, {})
+            elif op == 3:
+                fs.write(None, own_ino, pattern, random.randrange(16) * REGION_SIZE, {})
+            else:
+                # the request is the thread index, so the reply can be found again
+                fs.read(index, shared_ino, THREADS * REGION_SIZE, 0, {})
+                check_regions(fs.last_read.pop(index), errors)
+            ops += 1
+    except Exception as e:
+        errors.append(repr(e))
+    counts[index] = ops
+
+
+def main():
+    os.chdir(tempfile.mkdtemp())
+    sys.setswitchinterval(1e-5)
+    # keep uploads from starting while the test runs
+    fusepass.NOTE_CREATION_DELAY = fusepass.NOTE_UPDATE_DELAY = 3600
+
+    fs, notebook_ino = make_fuse(NOTES)
+    fs.last_read = {}
+    fs.reply_attr = lambda req, attr, timeout: None
+    fs.reply_entry = lambda req, entry: None
+    fs.reply_err = lambda req, err: None
+    fs.reply_write = lambda req, count: None
+    fs.reply_buf = lambda req, buf: fs.last_read.__setitem__(req, bytes(buf))
+
+    shared_ino = add_file(fs, notebook_ino, '.shared')
+    own_inos = [add_file(fs, notebook_ino, 'own %d' % i) for i in range(THREADS)]
+
+    counts = [0] * THREADS
+    errors = []
+    threads = [
+        Thread(target=worker, args=(fs, i, notebook_ino, shared_ino, own_inos[i], counts, errors))
+        for i in range(THREADS)]
+    started = default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = default_timer() - started
+
+    shared = bytes(fs.data[shared_ino])
+    check_regions(shared, errors)
+    for i in range(THREADS):
+        region = shared[i * REGION_SIZE:(i + 1) * REGION_SIZE]
+        if region and region != bytes([ord('A') + i]) * REGION_SIZE:
+            errors.append('region ' + str(i) + ' lost its writes')
+    for ino in [shared_ino] + own_inos:
+        if ino in fs.data and fs.attr[ino]['st_size'] != len(fs.data[ino]):
+            errors.append('st_size of ' + str(ino) + ' does not match its contents')
+
+    print('%d threads %10.0f ops/s' % (THREADS, sum(counts) / elapsed))
+    for error in errors[:10]:
+        print('error: ' + error)
+    print('FAILED' if errors else 'OK')
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+from __future__ import print_function, absolute_import, division
+
+from threading import Lock, RLock
+import mmap
+import os
+
+
+class BlobStore(object):
+
+    def __init__(self, segment_path):
+        """
+        Append-only segment file for note contents.
+
+        Blobs are never modified in place: a new version is appended and the caller keeps the
+        (offset, length) index. Reads are memoryview slices of a mmap of the segment,
+        so serving a read does not copy the blob. Superseded versions are dropped by copying the
+        live blobs into a new segment, see EvernoteFuse.compact_contents.
+        """
+        self.path = segment_path
+        self.lock = RLock()
+        self.map_lock = Lock()
+        self.fd = os.open(segment_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        self.end = os.fstat(self.fd).st_size
+        self.map = None
+        self.map_size = 0
+
+    def append(self, data):
+        """
+        :return: offset of the appended blob
+        """
+        with self.lock:
+            offset = self.end
+            view = memoryview(data)
+            while view:
+                written = os.write(self.fd, view)
+                view = view[written:]
+            self.end += len(data)
+            return offset
+
+    def view(self, offset, length):
+        if length <= 0:
+            return memoryview(b'')
+
+        if offset + length > self.map_size:
+            with self.map_lock:
+                if offset + length > self.map_size:
+                    # the segment has grown since it was mapped; views of the old map stay valid.
+                    # Nothing writes to the map, it is copy-on-write only to give writable buffers
+                    # that ctypes can pass to libfuse without a copy
+                    self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_COPY)
+                    self.map_size = len(self.map)
+
+        return memoryview(self.map)[offset:offset + length]
+
+    def release(self, offset, length):
+        """
+        drops resident pages of a blob, they are read back from the segment on the next access
+        """
+        if self.map is None or not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        start = -(-offset // mmap.PAGESIZE) * mmap.PAGESIZE
+        end = min(offset + length, self.map_size) // mmap.PAGESIZE * mmap.PAGESIZE
+        if end > start:
+            self.map.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def size(self):
+        return self.end
+
+    def sync(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        os.close(self.fd)
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
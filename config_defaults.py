@@ -0,0 +1,51 @@
+"""
+Defaults of the settings a config.py made from an older config.py.example does not have.
+config.py.example documents each of them.
+"""
+from __future__ import print_function, absolute_import, division
+
+BACKEND = 'evernote'
+SIMULATED_NOTE_STORE = dict(notebooks=10, notes_per_notebook=100, content_size=2048, latency=0.1,
+                            bandwidth=1024 * 1024, calls_per_hour=None, failure_rate=0.0, seed=0)
+
+NOTEBOOK_SYNC_PERIOD = 60 * 60
+NOTES_SYNC_PERIOD = 60 * 60
+NOTE_SYNC_PERIOD = 5 * 60
+
+NOTES_PAGE_SIZE = 250
+
+PREFETCH_CONCURRENCY = 4
+PREFETCH_NOTEBOOK_BUDGET = 100
+
+CONTENT_CACHE_SIZE = 64 * 1024 * 1024
+
+FUSE_MULTITHREADED = False
+
+LAZY_TREE = True
+
+NOTE_STALE_PERIOD = 24 * 60 * 60
+
+ATTR_TIMEOUT = 10 * 60
+ENTRY_TIMEOUT = 10 * 60
+
+API_CALLS_PER_HOUR = 500
+API_FOREGROUND_WAIT = 5
+
+STATS_FILE = '.stats'
+STATS_PROMETHEUS_FILE = None
+
+PROFILE_SIGNALS = True
+PROFILE_CONTROL_FILE = '.evernote_profile'
+PROFILE_DURATION = 30
+PROFILE_INTERVAL = 0.005
+PROFILE_DIR = 'profiles'
+
+
+def apply_defaults(config):
+    """
+    sets the settings config does not have to their defaults
+    :param config: the config module
+    """
+    for name, value in globals().items():
+        if name.isupper() and not hasattr(config, name):
+            setattr(config, name, value)
@@ -0,0 +1,90 @@
+from __future__ import print_function, absolute_import, division
+
+from collections import OrderedDict
+
+
+class ContentCache(object):
+
+    def __init__(self, limit):
+        """
+        LRU set of note contents kept resident, bounded by a byte budget.
+
+        Clean entries map a key to a value (e.g. a content location) and are evicted in least recently
+        used order once the budget is exceeded. Pinned entries, contents with changes pending upload,
+        count towards the budget but are never evicted. Callers hold EvernoteFuse.lock.
+
+        :param limit: budget in bytes
+        """
+        self.limit = limit
+        self.entries = OrderedDict()
+        self.pinned = {}
+        self.size = 0
+        self.stats = dict(hits=0, misses=0, evictions=0, evicted_bytes=0)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def items(self):
+        return [(key, value) for key, (value, size) in self.entries.items()]
+
+    def get(self, key):
+        """
+        :return: cached value, None on a miss
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size):
+        """
+        :return: list of evicted (key, value)
+        """
+        self.pop(key)
+        self.entries[key] = (value, size)
+        self.size += size
+        return self.evict()
+
+    def replace(self, key, value):
+        """
+        changes the value of an entry without touching its recency
+        """
+        self.entries[key] = (value, self.entries[key][1])
+
+    def pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self.size -= entry[1]
+        return entry[0]
+
+    def pin(self, key, size):
+        """
+        accounts for pinned contents, or updates their size
+        :return: list of evicted (key, value)
+        """
+        self.size += size - self.pinned.get(key, 0)
+        self.pinned[key] = size
+        return self.evict()
+
+    def unpin(self, key):
+        self.size -= self.pinned.pop(key, 0)
+
+    def evict(self):
+        evicted = []
+        while self.size > self.limit and self.entries:
+            key, (value, size) = self.entries.popitem(last=False)
+            self.size -= size
+            self.stats['evictions'] += 1
+            self.stats['evicted_bytes'] += size
+            evicted.append((key, value))
+        return evicted
+
+    def get_stats(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        stats = dict(self.stats, size=self.size, pinned=len(self.pinned))
+        stats['hit_rate'] = self.stats['hits'] / lookups if lookups else 0.0
+        return stats
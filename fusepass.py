@@ -2,25 +2,53 @@
 from __future__ import print_function, absolute_import, division
 
 from collections import defaultdict
-from errno import ENOENT
-from stat import S_IFMT, S_IMODE, S_IFDIR
+from copy import copy
+from concurrent.futures import ThreadPoolExecutor
+from errno import ENOENT, EIO, EAGAIN, EACCES, EPERM
+from itertools import count
+from os import O_ACCMODE, O_RDONLY
+from signal import SIGUSR1, SIGUSR2
+from stat import S_IFMT, S_IMODE, S_IFDIR, S_IFREG
 from time import time
-from os import path
-from threading import Timer
+from timeit import default_timer
+from threading import RLock, get_ident
 import logging
-import pickle
 
 import config
+import config_defaults
 
 from lib.fusell import FUSELL
-
-from evernote.edam.notestore.ttypes import NoteFilter
+from api_dispatcher import ApiDispatcher, RateLimited, API_FOREGROUND, API_WRITE, API_SYNC, API_PREFETCH
+from blob_store import BlobStore
+from content_cache import ContentCache
+from metadata_store import MetadataStore
+from metrics import Metrics
+from profiler import Profiler
+from sync_scheduler import SyncScheduler, PRIORITY_FOREGROUND
+from tree_snapshot import SnapshotError, TreeSnapshot, write_snapshot
+from upload_queue import UploadQueue
+
+from evernote.edam.notestore.ttypes import NoteFilter, NotesMetadataResultSpec, SyncChunkFilter
 from evernote.edam.type.ttypes import Note
 
-EVERNOTE_DATA_FILE = '.evernote_data'
-NOTES_LOAD_BATCH_SIZE = 100
+# settings a config.py made from an older example does not have
+config_defaults.apply_defaults(config)
+
+EVERNOTE_DB_FILE = '.evernote.db'
+EVERNOTE_CONTENTS_FILE = '.evernote_contents'
+EVERNOTE_SNAPSHOT_FILE = '.evernote.snapshot'  # tree written on unmount, read instead of the notes table on mount
+CONTENTS_COMPACTION_PERIOD = 60 * 60  # seconds
+CONTENTS_COMPACTION_MIN_SIZE = 16 * 1024 * 1024  # bytes, smaller segments are not worth compacting
+# listings only need what the tree shows, full notes come with attributes, tags and resource metadata
+NOTES_METADATA_SPEC = NotesMetadataResultSpec(
+    includeTitle=True, includeCreated=True, includeUpdated=True, includeContentLength=True,
+    includeUpdateSequenceNum=True)
+SYNC_CHUNK_SIZE = 100
+SYNC_WORKERS = 2
+UPLOAD_WORKERS = 2
 NOTE_CREATION_DELAY = 10.0  # seconds, to avoid creating notes out of temporary files
 NOTE_UPDATE_DELAY = 10.0  # seconds, to avoid updating note too frequently
+NOTE_RELEASE_DELAY = 0.5  # seconds, shortest wait for an upload after the last writer closes a file
 
 NOTE_HEAD_1 = '''<?xml version="1.0" encoding="UTF-8"?>'''
 NOTE_HEAD_2 = '''<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">'''
@@ -29,120 +57,360 @@ NOTE_HEAD_3 = '''<!DOCTYPE en-note SYSTEM 'http://xml.evernote.com/pub/enml2.dtd
 
 class EvernoteFuse(FUSELL):
 
-    def __init__(self, mount_point, evernote):
+    def __init__(self, mount_point, evernote, note_stale_period=None):
         """
         Evernote fuse
 
         :type evernote: evernote.api.client.EvernoteClient
+        :param note_stale_period: seconds past NOTE_SYNC_PERIOD during which open() serves the stored
+                                  note and refreshes it in background, config.NOTE_STALE_PERIOD by default
         """
         self.evernote = evernote
 
         self.notebooks = {}
         self.notebook_ino = {}
+        self.ino_notebook = {}
         self.notebooks_sync_time = 0
+        self.update_count = 0
+        self.changes_sync_time = 0
 
         self.notebooks_notes_sync_time = {}
         self.notebook_notes = {}
+        self.hydrated_notebooks = set()
+        self.snapshot = None
+        self.notebook_note_titles = {}
         self.notes_ino = {}
+        self.note_guid_ino = {}
         self.note_sync_time = {}
-
-        self.note_creation_timers = {}
-        self.note_update_timers = {}
-        self.note_rename_timers = {}
+        self.note_open_time = {}
+        self.prefetch_queued = set()
+        self.prefetched = set()
+        self.prefetch_stats = dict(fetched=0, hits=0, misses=0, stale=0, shed=0)
+        self.note_stale_period = config.NOTE_STALE_PERIOD if note_stale_period is None else note_stale_period
 
         self.root_ino = 1
         self.ino = self.root_ino
         self.attr = defaultdict(dict)
-        self.data = defaultdict(bytes)
+        self.data = {}
+        self.content_cache = ContentCache(config.CONTENT_CACHE_SIZE)
+        self.contents_lock = RLock()
         self.parent = {}
         self.children = defaultdict(dict)
-
-        if path.exists(EVERNOTE_DATA_FILE):
-            for k, v in pickle.load(open(EVERNOTE_DATA_FILE, 'rb')).items():
-                self.__setattr__(k, v)
-
-        self.note_store = self.evernote.get_note_store()
-
-        super(EvernoteFuse, self).__init__(mount_point)
+        self.dir_generation = defaultdict(int)
+        self.dir_buffers = {}
+        self.dir_handles = {}
+        self.dir_handle_seq = count(1)
+        self.child_names = {}
+        self.lock = RLock()
+        self.invalidations = []
+        self.writers = defaultdict(int)
+        self.writers_release_time = {}
+        self.release_delay = {}
+        self.metrics = Metrics()
+        self.request_tags = {}
+        # started first, so that the threads started below leave its signals to it
+        self.profiler = Profiler(
+            config.PROFILE_DIR, config.PROFILE_DURATION, config.PROFILE_INTERVAL, self.get_request_tags,
+            {SIGUSR1: 'cpu', SIGUSR2: 'memory'} if config.PROFILE_SIGNALS else None, config.PROFILE_CONTROL_FILE)
+        self.stats_files = {}
+        self.stats_snapshots = {}
+
+        self.store = MetadataStore(EVERNOTE_DB_FILE)
+        self.notebooks_sync_time = self.store.get_state('notebooks_sync_time', 0)
+        self.update_count = self.store.get_state('update_count', 0)
+        self.changes_sync_time = self.store.get_state('changes_sync_time', 0)
+        self.contents = BlobStore(self.store.get_state('content_segment', EVERNOTE_CONTENTS_FILE))
+
+        self.api = ApiDispatcher(
+            self.evernote.get_note_store(), config.API_CALLS_PER_HOUR, config.API_FOREGROUND_WAIT, self.metrics)
+        self.sync_scheduler = SyncScheduler(SYNC_WORKERS)
+        self.upload_queue = UploadQueue(UPLOAD_WORKERS, self.upload_note)
+        self.prefetch_pool = ThreadPoolExecutor(max_workers=config.PREFETCH_CONCURRENCY)
+
+        super(EvernoteFuse, self).__init__(mount_point, multithreaded=config.FUSE_MULTITHREADED)
 
     def destroy(self, user_data):
         """
-        save all data to file here, to do less syncing next time
+        state is persisted as it changes, only pending uploads have to be made and background work stopped here
+        """
+        self.sync_scheduler.stop()
+        # local changes are only kept in memory, they are lost unless uploaded now
+        for ino in self.upload_queue.drain():
+            with self.lock:
+                name = self.find_child_by_parent_and_ino(self.parent.get(ino), ino)
+            logging.error('unmount: changes of ' + str(name) + ' (inode ' + str(ino) + ') were not uploaded')
+        self.profiler.stop()
+        self.prefetch_pool.shutdown(wait=False)
+        logging.info('prefetch: ' + str(self.prefetch_stats))
+        logging.info('uploads: ' + str(self.upload_queue.get_stats()))
+        logging.info('content cache: ' + str(self.content_cache.get_stats()))
+        logging.info('api: ' + str(self.api.get_stats()))
+        logging.info('metrics:\n' + self.metrics.render_text([]))
+        with self.lock:
+            # nothing may change the store once the snapshot is taken
+            self.write_snapshot()
+            self.store.close()
+        self.contents.close()
+
+    def instrument(self, name, method):
+        """
+        times every request, by operation, and tags the thread serving it for the profiler
         """
-        pickle.dump({
-            'notebooks': self.notebooks,
-            'notebooks_sync_time': self.notebooks_sync_time,
-            'notebooks_notes_sync_time': self.notebooks_notes_sync_time,
-            'notebook_notes': self.notebook_notes,
-            'note_sync_time': self.note_sync_time,
-            'data': self.data,
-        }, open(EVERNOTE_DATA_FILE, 'wb'))
+        observe = self.metrics.observe
+        tags = self.request_tags
+        tag = 'fuse:' + name
+
+        def timed(*args):
+            ident = get_ident()
+            tags[ident] = tag
+            started = default_timer()
+            failed = True
+            try:
+                result = method(*args)
+                failed = False
+                return result
+            finally:
+                observe('request', name, default_timer() - started, failed)
+                tags.pop(ident, None)
+        return timed
+
+    def get_request_tags(self):
+        return dict(self.request_tags)
+
+    def open_snapshot(self):
+        """
+        :return: snapshot written by the last unmount, None if there is none or the store changed after it
+        """
+        generation = self.store.get_state('snapshot_generation', 0)
+        snapshot = None
+        try:
+            snapshot = TreeSnapshot(EVERNOTE_SNAPSHOT_FILE)
+            if snapshot.generation != generation:
+                logging.info('snapshot is outdated, loading the tree from the store')
+                snapshot.close()
+                snapshot = None
+        except EnvironmentError:
+            pass
+        except SnapshotError as e:
+            logging.warning(str(e))
+        # changes made from now on are not in the snapshot until it is written again, on unmount
+        self.store.set_state('snapshot_generation', generation + 1)
+        return snapshot
+
+    def write_snapshot(self):
+        """
+        notes of notebooks not hydrated during this mount are copied from the previous snapshot
+        """
+        with self.lock, self.store.lock:
+            notebooks = []
+            for notebook_guid, notebook in self.notebooks.items():
+                if notebook_guid in self.hydrated_notebooks:
+                    notes = [(note, self.note_guid_ino[note.guid], self.note_sync_time.get(note.guid))
+                             for note in self.notebook_notes.get(notebook_guid, {}).values()]
+                elif self.snapshot is not None:
+                    notes = self.snapshot.get_notebook_notes(notebook_guid)
+                else:
+                    notes = self.store.load_notebook_notes(notebook_guid)
+                notebooks.append((
+                    notebook, self.notebook_ino[notebook_guid], self.notebooks_notes_sync_time.get(notebook_guid), notes))
+            try:
+                write_snapshot(EVERNOTE_SNAPSHOT_FILE, self.store.get_state('snapshot_generation', 0), notebooks)
+                logging.info('snapshot written: ' + str(len(notebooks)) + ' notebooks')
+            except EnvironmentError:
+                logging.exception('snapshot failed, the next mount loads the tree from the store')
+            if self.snapshot is not None:
+                self.snapshot.close()
+                self.snapshot = None
 
     def should_sync_note(self, note):
         return (note.guid not in self.note_sync_time or
                 self.note_sync_time[note.guid] + config.NOTE_SYNC_PERIOD <= time())
 
-    def create_note(self, ino):
-        note_name = self.find_child_by_parent_and_ino(self.parent[ino], ino)
-        logging.info('create note: ' + note_name)
+    def can_serve_stale_note(self, ino, note):
+        """
+        :return: True if the stored copy of an expired note is recent enough to be served while it is refreshed
+        """
+        return (self.note_stale_period > 0 and
+                (note.guid in self.content_cache or ino in self.data) and
+                self.note_sync_time.get(note.guid, 0) + config.NOTE_SYNC_PERIOD + self.note_stale_period > time())
+
+    def upload_note(self, ino, kinds):
+        """
+        uploads all changes queued for a file with one API call
+        :param kinds: set of 'create', 'update' and 'rename'
+        """
+        with self.lock:
+            parent = self.parent.get(ino)
+            note_name = self.find_child_by_parent_and_ino(parent, ino)
+            if note_name is None or note_name.startswith('.') or parent not in self.ino_notebook:
+                # deleted, hidden again or moved out of notebooks before the upload
+                return
+            notebook_guid = self.ino_notebook[parent]
+            note = self.notes_ino.get(ino)
+            content = bytes(self.get_note_content(ino)) if note is None or 'update' in kinds else None
+
+        if note is None:
+            self.create_note(ino, note_name, notebook_guid, content)
+        else:
+            self.update_note(ino, note, note_name, notebook_guid, content)
 
-        notebook_guid = self.get_notebook_by_ino(self.parent[ino]).guid
+    def create_note(self, ino, note_name, notebook_guid, content):
+        logging.info('create note: ' + note_name)
 
         note = Note()
         note.title = note_name
         note.notebookGuid = notebook_guid
-        note.content = self.get_note_content_by_ino(ino)
-        created_note = self.note_store.createNote(note)
-        self.notes_ino[ino] = created_note
-        self.notebook_notes[notebook_guid][created_note.guid] = created_note
-
-    def update_note(self, ino):
-        note_name = self.find_child_by_parent_and_ino(self.parent[ino], ino)
+        note.content = self.get_note_enml(content)
+        created_note = self.api.call(API_WRITE, 'createNote', note)
+        with self.lock:
+            self.set_note_ino(ino, created_note)
+            self.put_notebook_note(created_note)
+            self.store.put_note(created_note, ino)
+        self.store_uploaded_content(ino, created_note, content)
+
+    def update_note(self, ino, note, note_name, notebook_guid, content):
+        """
+        :param content: None to keep the content, when the note was only renamed or moved
+        """
         logging.info('update note: ' + note_name)
 
-        notebook_guid = self.get_notebook_by_ino(self.parent[ino]).guid
-        note = self.find_note_by_name(notebook_guid, note_name)
-        note.content = self.get_note_content_by_ino(ino)
-        updated_note = self.note_store.updateNote(note)
-        self.notes_ino[ino] = updated_note
-        self.notebook_notes[notebook_guid][updated_note.guid] = updated_note
-
-    def rename_note(self, ino):
-        note_name = self.find_child_by_parent_and_ino(self.parent[ino], ino)
-        logging.info('rename note: ' + note_name)
-
-        notebook_guid = self.get_notebook_by_ino(self.parent[ino]).guid
-        note = self.notes_ino[ino]
+        note = copy(note)
         note.title = note_name
         note.notebookGuid = notebook_guid
-        updated_note = self.note_store.updateNote(note)
-        self.notes_ino[ino] = updated_note
-        if notebook_guid not in self.notebook_notes:
-            self.notebook_notes[notebook_guid] = {}
-        self.notebook_notes[notebook_guid][updated_note.guid] = updated_note
+        if content is not None:
+            note.content = self.get_note_enml(content)
+        updated_note = self.api.call(API_WRITE, 'updateNote', note)
+        with self.lock:
+            self.drop_notebook_note(self.notes_ino[ino])
+            self.set_note_ino(ino, updated_note)
+            self.put_notebook_note(updated_note)
+            self.store.put_note(updated_note, ino)
+        if content is not None:
+            self.store_uploaded_content(ino, updated_note, content)
+
+    def get_note_enml(self, content):
+        return NOTE_HEAD_1 + NOTE_HEAD_2 + '<en-note>' + content.decode('utf8') + '</en-note>'
+
+    def get_note_content(self, ino):
+        """
+        :return: buffer with local changes if the file is being edited, otherwise a view of synced contents
+        """
+        with self.lock:
+            data = self.data.get(ino)
+            if data is not None:
+                return data
+            note = self.notes_ino.get(ino)
+            location = self.content_cache.get(note.guid) if note is not None else None
+            if location is None and note is not None:
+                # evicted, load the location again from the index
+                location = self.store.get_note_content_location(note.guid)
+                if location is not None:
+                    self.cache_content(note.guid, tuple(location))
+            contents = self.contents
+        if location is None:
+            return memoryview(b'')
+        return contents.view(*location)
+
+    def get_write_buffer(self, ino):
+        if ino not in self.data:
+            # copy on write, synced contents stay in the blob store
+            self.data[ino] = bytearray(self.get_note_content(ino))
+        return self.data[ino]
+
+    def cache_content(self, note_guid, location):
+        self.release_contents(self.content_cache.put(note_guid, location, location[1]))
+
+    def pin_content(self, ino):
+        """
+        accounts for the buffer of a note with local changes, it stays in memory until uploaded
+        """
+        with self.lock:
+            self.release_contents(self.content_cache.pin(ino, len(self.data[ino])))
 
-    def get_note_content_by_ino(self, ino):
-        content = self.data[ino].decode('utf8')
-        return NOTE_HEAD_1 + NOTE_HEAD_2 + '<en-note>' + content + '</en-note>'
+    def release_contents(self, evicted):
+        for note_guid, (offset, length) in evicted:
+            self.contents.release(offset, length)
+
+    def store_uploaded_content(self, ino, note, content):
+        """
+        moves uploaded contents to the blob store, unless they were changed again during the upload
+        """
+        with self.contents_lock:
+            offset = self.contents.append(content)
+            with self.lock:
+                self.store.put_note_content(note.guid, offset, len(content), self.note_sync_time.get(note.guid))
+                if self.data.get(ino) == content:
+                    del self.data[ino]
+                    self.content_cache.unpin(ino)
+                self.cache_content(note.guid, (offset, len(content)))
+
+    def compact_contents(self):
+        """
+        copies live contents to a new segment once most of the current one is superseded versions
+        """
+        with self.contents_lock:
+            size = self.contents.size()
+            live_size = self.store.get_live_content_size()
+            if size < CONTENTS_COMPACTION_MIN_SIZE or live_size * 2 > size:
+                return
+
+            logging.info('compact contents: ' + str(size) + ' -> ' + str(live_size) + ' bytes')
+            segment_path = EVERNOTE_CONTENTS_FILE + '.' + str(int(time() * 1000))
+            compacted = BlobStore(segment_path)
+            locations = []
+            for note_guid, offset, length in self.store.load_content_index():
+                locations.append((note_guid, compacted.append(self.contents.view(offset, length)), length))
+            compacted.sync()
+
+            with self.lock:
+                self.store.set_content_index(locations, segment_path)
+                index = dict((note_guid, (offset, length)) for note_guid, offset, length in locations)
+                for note_guid, location in self.content_cache.items():
+                    if note_guid in index:
+                        self.content_cache.replace(note_guid, index[note_guid])
+                    else:
+                        self.content_cache.pop(note_guid)
+                previous, self.contents = self.contents, compacted
+
+            # views of the old segment that are still being replied stay valid until released
+            previous.remove()
+            logging.info('compact contents - done')
 
     def find_note_by_name(self, notebook_guid, name):
-        for note in self.notebook_notes[notebook_guid].values():
-            if note.title == name:
-                return note
+        return self.notebook_note_titles.get((notebook_guid, name))
 
     def get_note_ino(self, note_guid):
-        for ino, note in self.notes_ino.items():
-            if note.guid == note_guid:
-                return ino
+        return self.note_guid_ino.get(note_guid)
+
+    def put_notebook_note(self, note):
+        if note.notebookGuid not in self.notebook_notes:
+            self.notebook_notes[note.notebookGuid] = {}
+        self.notebook_notes[note.notebookGuid][note.guid] = note
+        self.notebook_note_titles[(note.notebookGuid, note.title)] = note
+
+    def drop_notebook_note(self, note):
+        """
+        must be called before note title or notebook is changed, so that title index stays consistent
+        """
+        self.notebook_notes.get(note.notebookGuid, {}).pop(note.guid, None)
+        key = (note.notebookGuid, note.title)
+        if key in self.notebook_note_titles and self.notebook_note_titles[key].guid == note.guid:
+            del self.notebook_note_titles[key]
+
+    def set_note_ino(self, ino, note):
+        self.notes_ino[ino] = note
+        self.note_guid_ino[note.guid] = ino
 
-    def sync_note(self, note):
+    def sync_note(self, note, priority=API_SYNC):
+        """
+        :return: True if the note has new content
+        """
         if not self.should_sync_note(note):
-            return
+            return False
 
         logging.info('sync note: ' + note.title)
-        ino = self.get_note_ino(note.guid)
 
-        note_content = self.note_store.getNoteContent(note.guid)
+        note_content = self.api.call(priority, 'getNoteContent', note.guid)
         note_content = note_content.strip()
         if note_content.startswith(NOTE_HEAD_1):
             note_content = note_content.replace(NOTE_HEAD_1, '', 1).strip()
@@ -156,17 +424,92 @@ class EvernoteFuse(FUSELL):
         note_content = note_content[len('<en-note>'):len(note_content) - len('</en-note>')].strip()
 
         note_content_bytes = note_content.encode('utf-8')
-        self.data[ino] = note_content_bytes
-        self.attr[ino]['st_size'] = len(note_content_bytes)
+        with self.contents_lock:
+            with self.lock:
+                ino = self.get_note_ino(note.guid)
+                if ino is None:
+                    # note was deleted while its content was loading
+                    return False
+                if ino not in self.data and self.get_note_content(ino) == note_content_bytes:
+                    # nothing changed, there is no need to store another copy
+                    self.note_sync_time[note.guid] = time()
+                    self.store.set_note_sync_time(note.guid, self.note_sync_time[note.guid])
+                    logging.info('sync note - unchanged: ' + note.title)
+                    return False
+
+            offset = self.contents.append(note_content_bytes)
+            with self.lock:
+                ino = self.get_note_ino(note.guid)
+                if ino is None:
+                    return False
+                self.data.pop(ino, None)
+                self.content_cache.unpin(ino)
+                self.cache_content(note.guid, (offset, len(note_content_bytes)))
+                self.attr[ino]['st_size'] = len(note_content_bytes)
+                self.note_sync_time[note.guid] = time()
+                self.store.put_note_content(
+                    note.guid, offset, len(note_content_bytes), self.note_sync_time[note.guid])
+                # the kernel may still cache the previous size and content
+                self.queue_invalidation(ino)
 
-        self.note_sync_time[note.guid] = time()
         logging.info('sync note - done: ' + note.title)
+        return True
+
+    def load_note_content(self, ino, note):
+        location = self.store.get_note_content_location(note.guid)
+        with self.lock:
+            if location is None:
+                self.note_sync_time.pop(note.guid, None)
+            else:
+                self.cache_content(note.guid, tuple(location))
+                if ino not in self.data:
+                    self.attr[ino]['st_size'] = location[1]
+
+    def background_sync_note(self, note_guid):
+        """
+        keeps notes opened during the last sync period fresh, other notes drop out of background sync
+        """
+        with self.lock:
+            ino = self.get_note_ino(note_guid)
+            if ino is None or self.note_open_time.get(note_guid, 0) < self.note_sync_time.get(note_guid, 0):
+                return False
+            note = self.notes_ino[ino]
+        self.sync_note(note)
+
+    def prefetch_notebook_notes(self, notebook_guid):
+        """
+        tools that list a notebook usually open every note in it next, so load the most recently
+        updated contents concurrently before they are asked for
+        """
+        with self.lock:
+            notes = [note for note in self.notebook_notes.get(notebook_guid, {}).values()
+                     if note.guid not in self.prefetch_queued and self.should_sync_note(note)]
+        notes.sort(key=lambda note: note.updated or 0, reverse=True)
+
+        for note in notes[:config.PREFETCH_NOTEBOOK_BUDGET]:
+            self.prefetch_queued.add(note.guid)
+            self.prefetch_pool.submit(self.prefetch_note, note)
+
+    def prefetch_note(self, note):
+        try:
+            self.sync_scheduler.run(('note', note.guid), self.sync_note, [note, API_PREFETCH])
+            with self.lock:
+                if note.guid in self.note_sync_time:
+                    self.prefetched.add(note.guid)
+                    self.prefetch_stats['fetched'] += 1
+        except RateLimited:
+            with self.lock:
+                self.prefetch_stats['shed'] += 1
+        except Exception:
+            logging.exception('prefetch failed: ' + note.title)
+        finally:
+            self.prefetch_queued.discard(note.guid)
 
     def should_sync_notebook_notes(self, notebook):
         return (notebook.guid not in self.notebooks_notes_sync_time or
-                self.notebooks_notes_sync_time[notebook.guid] + config.NOTEBOOK_NOTES_SYNC_PERIOD <= time())
+                self.notebooks_notes_sync_time[notebook.guid] + config.NOTES_SYNC_PERIOD <= time())
 
-    def sync_notebook_notes(self, notebook):
+    def sync_notebook_notes(self, notebook, priority=API_SYNC):
         if not self.should_sync_notebook_notes(notebook):
             return
 
@@ -174,89 +517,450 @@ class EvernoteFuse(FUSELL):
         note_filter = NoteFilter()
         note_filter.notebookGuid = notebook.guid
 
-        note_list = []
-        current_offset = 0
+        self.hydrate_notebook(notebook.guid)
+        with self.lock:
+            # notes created locally while the notebook is listed are not in the listing
+            prev_note_guids = set(self.notebook_notes.get(notebook.guid, {}))
+        listed_note_guids = set()
+        offset = 0
         while True:
-            logging.info('sync notebook: ' + notebook.name + ' - ' + str(current_offset))
-            note_batch = self.note_store.findNotes(note_filter, current_offset, NOTES_LOAD_BATCH_SIZE + 1)
-            if len(note_batch.notes) < NOTES_LOAD_BATCH_SIZE + 1:
-                note_list += note_batch.notes
+            logging.info('sync notebook: ' + notebook.name + ' - ' + str(offset))
+            page = self.api.call(
+                priority, 'findNotesMetadata', note_filter, offset, config.NOTES_PAGE_SIZE, NOTES_METADATA_SPEC)
+
+            # each page is applied as it arrives, so a large notebook fills in while it is listed
+            with self.lock, self.store.transaction():
+                if notebook.guid not in self.notebook_ino:
+                    # notebook was deleted while its notes were loading
+                    return
+                for metadata in page.notes:
+                    listed_note_guids.add(metadata.guid)
+                    self.apply_listed_note(notebook, metadata)
+
+            offset = page.startIndex + len(page.notes)
+            if not page.notes or offset >= page.totalNotes:
                 break
-            else:
-                note_list += note_batch.notes[:-1]
-                current_offset += NOTES_LOAD_BATCH_SIZE
 
-        if notebook.guid in self.notebook_notes:
-            prev_notes = self.notebook_notes[notebook.guid].copy()
-        else:
-            prev_notes = {}
-        new_notes = {}
-
-        for note in note_list:
-            new_notes[note.guid] = note
-            if note.guid not in prev_notes:
-                logging.info('sync new note: ' + note.title)
-                self.add_notebook_note_to_fuse(note)
-            elif note.title != prev_notes[note.guid].title:
-                logging.info('sync note renamed: ' + prev_notes[note.guid].title + '->' + note.title)
-                self.rename_notebook_note_in_fuse(note.notebookGuid, prev_notes[note.guid].title, note.title)
-
-        for prev_note_guid, prev_note in prev_notes.items():
-            if prev_note_guid not in new_notes:
-                logging.info('sync: note deleted: ' + prev_note.name)
-                self.remove_notebook_note_from_fuse(prev_note.notebookGuid, prev_note_guid)
-
-        self.notebook_notes[notebook.guid] = new_notes
+        with self.lock, self.store.transaction():
+            if notebook.guid not in self.notebook_ino:
+                return
+
+            for prev_note_guid in prev_note_guids - listed_note_guids:
+                prev_note = self.notebook_notes.get(notebook.guid, {}).get(prev_note_guid)
+                if prev_note is not None:
+                    logging.info('sync: note deleted: ' + prev_note.title)
+                    self.remove_notebook_note_from_fuse(prev_note)
+                    self.store.delete_note(prev_note_guid)
+
+            self.notebooks_notes_sync_time[notebook.guid] = time()
+            self.store.set_notebook_notes_sync_time(notebook.guid, self.notebooks_notes_sync_time[notebook.guid])
+
         logging.info('sync notebook - done: ' + notebook.name)
-        self.notebooks_notes_sync_time[notebook.guid] = time()
+
+    def apply_listed_note(self, notebook, metadata):
+        """
+        :type metadata: evernote.edam.notestore.ttypes.NoteMetadata
+        """
+        note = Note(
+            guid=metadata.guid,
+            title=metadata.title,
+            notebookGuid=notebook.guid,
+            created=metadata.created,
+            updated=metadata.updated,
+            contentLength=metadata.contentLength,
+            updateSequenceNum=metadata.updateSequenceNum,
+            active=True)
+
+        ino = self.get_note_ino(note.guid)
+        if ino is None:
+            # the note may have been moved from a notebook not hydrated yet
+            self.hydrate_note(note.guid)
+            ino = self.get_note_ino(note.guid)
+        prev_note = self.notes_ino[ino] if ino is not None else None
+        if prev_note is None:
+            logging.info('sync new note: ' + note.title)
+            self.add_notebook_note_to_fuse(note)
+            self.store.put_note(note, self.get_note_ino(note.guid))
+            return
+
+        if prev_note.updateSequenceNum == note.updateSequenceNum:
+            # the listing does not include the hash, it is unchanged along with the note
+            note.contentHash = prev_note.contentHash
+        if note.title != prev_note.title or note.notebookGuid != prev_note.notebookGuid:
+            logging.info('sync note renamed: ' + prev_note.title + '->' + note.title)
+            self.rename_notebook_note_in_fuse(prev_note, note)
+        else:
+            self.set_note_ino(ino, note)
+            self.put_notebook_note(note)
+        if prev_note.updateSequenceNum != note.updateSequenceNum:
+            self.store.put_note(note, ino)
+
+    def background_sync_notebook_notes(self, notebook_guid):
+        with self.lock:
+            if notebook_guid not in self.notebooks:
+                return False
+            notebook = self.notebooks[notebook_guid]
+        self.sync_notebook_notes(notebook)
 
     def should_sync_notebooks(self):
         return self.notebooks_sync_time + config.NOTEBOOK_SYNC_PERIOD <= time()
 
-    def sync_notebooks(self):
+    def sync_notebooks(self, priority=API_SYNC):
         if not self.should_sync_notebooks():
             # it is too early to sync
             return
 
         logging.info('sync: notebooks')
 
-        prev_notebooks = self.notebooks.copy()
+        notebooks = self.api.call(priority, 'listNotebooks')
+
+        with self.lock, self.store.transaction():
+            prev_notebooks = self.notebooks.copy()
+            new_notebooks = {}
+
+            for notebook in notebooks:
+                new_notebooks[notebook.guid] = notebook
+                self.notebooks[notebook.guid] = notebook
+                if notebook.guid not in prev_notebooks:
+                    logging.info('sync: new notebook: ' + notebook.name)
+                    self.add_notebook_to_fuse(notebook.guid)
+                elif notebook.name != prev_notebooks[notebook.guid].name:
+                    logging.info('sync: notebook renamed: ' + prev_notebooks[notebook.guid].name + '->' + notebook.name)
+                    self.rename_notebook_in_fuse(prev_notebooks[notebook.guid].name, notebook.name)
+                self.store.put_notebook(notebook, self.notebook_ino[notebook.guid])
+
+            for prev_notebook_guid, prev_notebook in prev_notebooks.items():
+                if prev_notebook_guid not in new_notebooks:
+                    logging.info('sync: notebook deleted: ' + prev_notebook.name)
+                    self.remove_notebook_from_fuse(prev_notebook_guid)
+                    del self.notebooks[prev_notebook_guid]
+                    self.store.delete_notebook(prev_notebook_guid)
+
+            self.notebooks_sync_time = time()
+            self.store.set_state('notebooks_sync_time', self.notebooks_sync_time)
+
+        for notebook_guid in new_notebooks:
+            if self.should_sync_notebook_notes(new_notebooks[notebook_guid]):
+                self.schedule_notebook_notes_sync(notebook_guid)
 
-        for notebook in self.note_store.listNotebooks():
-            self.notebooks[notebook.guid] = notebook
-            if notebook.guid not in prev_notebooks:
-                logging.info('sync: new notebook: ' + notebook.name)
-                self.add_notebook_to_fuse(notebook.guid)
-            elif notebook.name != prev_notebooks[notebook.guid].name:
-                logging.info('sync: notebook renamed: ' + prev_notebooks[notebook.guid].name + '->' + notebook.name)
-                self.rename_notebook_in_fuse(prev_notebooks[notebook.guid].name, notebook.name)
-
-        for prev_notebook_guid, prev_notebook in prev_notebooks.items():
-            if prev_notebook_guid not in self.notebooks:
-                logging.info('sync: notebook deleted: ' + prev_notebook.name)
-                self.remove_notebook_from_fuse(prev_notebook_guid)
-
-        self.notebooks_sync_time = time()
         logging.info('sync: notebooks - done')
 
-    def remove_notebook_note_from_fuse(self, notebook_guid, note_guid):
-        parent = self.notebook_ino[notebook_guid]
-        note_name = self.notebook_notes[notebook_guid][note_guid]
-        ino = self.children[parent][note_name]
+    def sync_changes(self, priority=API_SYNC):
+        """
+        incremental sync: pulls only what changed since the last known update count,
+        so when nothing changed it costs a single getSyncState call
+        """
+        sync_state = self.api.call(priority, 'getSyncState')
+        if sync_state.updateCount == self.update_count:
+            logging.info('sync: no changes')
+            with self.lock, self.store.transaction():
+                # listings are as fresh as this check, readdir does not need to list them again
+                self.refresh_sync_times()
+                self.changes_sync_time = sync_state.currentTime
+                self.store.set_state('changes_sync_time', self.changes_sync_time)
+            return
+
+        if self.update_count == 0 or sync_state.fullSyncBefore > self.changes_sync_time:
+            # no usable baseline, list everything and continue incrementally from this point
+            logging.info('sync: full')
+            self.notebooks_sync_time = 0
+            self.notebooks_notes_sync_time.clear()
+            self.store.clear_notebooks_notes_sync_time()
+            self.sync_notebooks(priority)
+            with self.store.transaction():
+                self.update_count = sync_state.updateCount
+                self.changes_sync_time = sync_state.currentTime
+                self.store.set_state('update_count', self.update_count)
+                self.store.set_state('changes_sync_time', self.changes_sync_time)
+            return
+
+        logging.info('sync: changes after ' + str(self.update_count))
+        sync_filter = SyncChunkFilter(includeNotes=True, includeNotebooks=True, includeExpunged=True)
+        notebooks = {}
+        notes = {}
+        expunged_notebooks = set()
+        expunged_notes = set()
+        after_usn = self.update_count
+        while after_usn < sync_state.updateCount:
+            chunk = self.api.call(priority, 'getFilteredSyncChunk', after_usn, SYNC_CHUNK_SIZE, sync_filter)
+            for notebook in chunk.notebooks or []:
+                notebooks[notebook.guid] = notebook
+            for note in chunk.notes or []:
+                notes[note.guid] = note
+            for notebook_guid in chunk.expungedNotebooks or []:
+                notebooks.pop(notebook_guid, None)
+                expunged_notebooks.add(notebook_guid)
+            for note_guid in chunk.expungedNotes or []:
+                notes.pop(note_guid, None)
+                expunged_notes.add(note_guid)
+            if chunk.chunkHighUSN is None:
+                # the remaining changes are of tags, searches or linked notebooks, which are not synced
+                after_usn = max(after_usn, chunk.updateCount)
+                break
+            after_usn = chunk.chunkHighUSN
+
+        with self.lock, self.store.transaction():
+            for notebook in notebooks.values():
+                prev_notebook = self.notebooks.get(notebook.guid)
+                self.notebooks[notebook.guid] = notebook
+                if prev_notebook is None:
+                    logging.info('sync: new notebook: ' + notebook.name)
+                    self.add_notebook_to_fuse(notebook.guid)
+                elif notebook.name != prev_notebook.name:
+                    logging.info('sync: notebook renamed: ' + prev_notebook.name + '->' + notebook.name)
+                    self.rename_notebook_in_fuse(prev_notebook.name, notebook.name)
+                self.store.put_notebook(notebook, self.notebook_ino[notebook.guid])
+
+            for note in notes.values():
+                self.apply_note_change(note)
+
+            for note_guid in expunged_notes:
+                self.hydrate_note(note_guid)
+                ino = self.get_note_ino(note_guid)
+                if ino is not None:
+                    logging.info('sync: note deleted: ' + self.notes_ino[ino].title)
+                    self.remove_notebook_note_from_fuse(self.notes_ino[ino])
+                self.store.delete_note(note_guid)
+
+            for notebook_guid in expunged_notebooks:
+                if notebook_guid in self.notebooks:
+                    logging.info('sync: notebook deleted: ' + self.notebooks[notebook_guid].name)
+                    self.remove_notebook_from_fuse(notebook_guid)
+                    del self.notebooks[notebook_guid]
+                self.store.delete_notebook(notebook_guid)
+
+            self.refresh_sync_times()
+            self.update_count = after_usn
+            self.changes_sync_time = sync_state.currentTime
+            self.store.set_state('update_count', self.update_count)
+            self.store.set_state('changes_sync_time', self.changes_sync_time)
+
+        for notebook in notebooks.values():
+            if self.should_sync_notebook_notes(notebook):
+                self.schedule_notebook_notes_sync(notebook.guid)
+
+        logging.info('sync: changes - done, ' + str(len(notebooks)) + ' notebooks, ' + str(len(notes)) + ' notes')
+
+    def refresh_sync_times(self):
+        """
+        marks the notebooks and the notebook listings synced so far as synced now
+        """
+        now = time()
+        self.notebooks_sync_time = now
+        for notebook_guid in self.notebooks_notes_sync_time:
+            self.notebooks_notes_sync_time[notebook_guid] = now
+        self.store.set_notebooks_notes_sync_time(now)
+        self.store.set_state('notebooks_sync_time', self.notebooks_sync_time)
+
+    def apply_note_change(self, note):
+        if note.notebookGuid not in self.notebook_ino:
+            return
+        self.hydrate_note(note.guid)
+        self.hydrate_notebook(note.notebookGuid)
+
+        ino = self.get_note_ino(note.guid)
+        if ino is not None and ino not in self.parent:
+            # its file is no longer in the tree, the note is added again unless it was deleted
+            self.forget_note(self.notes_ino[ino])
+            ino = None
+        if not note.active:
+            if ino is not None:
+                logging.info('sync: note deleted: ' + note.title)
+                self.remove_notebook_note_from_fuse(self.notes_ino[ino])
+            self.store.delete_note(note.guid)
+            return
+
+        if ino is None:
+            logging.info('sync new note: ' + note.title)
+            self.add_notebook_note_to_fuse(note)
+            self.store.put_note(note, self.get_note_ino(note.guid))
+            return
+
+        prev_note = self.notes_ino[ino]
+        if note.title != prev_note.title or note.notebookGuid != prev_note.notebookGuid:
+            logging.info('sync note moved: ' + prev_note.title + '->' + note.title)
+            self.rename_notebook_note_in_fuse(prev_note, note)
+        else:
+            self.set_note_ino(ino, note)
+            self.put_notebook_note(note)
+        self.store.put_note(note, ino)
+
+        if note.contentHash != prev_note.contentHash:
+            # cached content is outdated, refetch it on next open or right away if the note is in use
+            self.note_sync_time.pop(note.guid, None)
+            self.store.expire_note_content(note.guid)
+            self.attr[ino]['st_mtime'] = note.updated or time()
+            self.queue_invalidation(ino)
+            if note.guid in self.note_open_time:
+                self.schedule_note_sync(note.guid)
+
+    def queue_content_upload(self, ino):
+        """
+        queues the upload of changed contents, the delay is only a fallback for files kept open:
+        the upload is moved up when the last writer closes the file
+        """
+        parent = self.parent.get(ino)
+        note_name = self.find_child_by_parent_and_ino(parent, ino)
+        if note_name is None or note_name.startswith('.') or parent not in self.ino_notebook:
+            # hidden, or removed while it is still open
+            return
+        if self.find_note_by_name(self.ino_notebook[parent], note_name) is None:
+            self.upload_queue.add(ino, 'create', NOTE_CREATION_DELAY)
+        else:
+            self.upload_queue.add(ino, 'update', NOTE_UPDATE_DELAY)
+
+    def open_writer(self, ino):
+        """
+        adapts the wait after the last writer closes a file to how the file is written: editors saving
+        in several passes reopen it shortly after closing, then the wait grows so all passes end in one upload
+        """
+        self.writers[ino] += 1
+        released = self.writers_release_time.pop(ino, None)
+        if released is None:
+            return
+        delay = self.release_delay.get(ino, NOTE_RELEASE_DELAY)
+        if time() - released < 2 * delay:
+            self.release_delay[ino] = min(2 * delay, NOTE_UPDATE_DELAY)
+        else:
+            self.release_delay[ino] = max(delay / 2, NOTE_RELEASE_DELAY)
+        # keep the upload of the previous pass back while the file is written again
+        self.upload_queue.reschedule(ino, NOTE_UPDATE_DELAY)
+
+    def release_writer(self, ino):
+        self.writers[ino] -= 1
+        if self.writers[ino] > 0:
+            return
+        del self.writers[ino]
+        if ino in self.attr:
+            self.writers_release_time[ino] = time()
+            self.upload_queue.reschedule(ino, self.release_delay.get(ino, NOTE_RELEASE_DELAY))
 
-        del self.children[parent][note_name]
+    def replace_ino(self, replaced, ino):
+        """
+        removes a file a rename replaces, a file that is not a note yet takes over its note
+
+        :return: the note taken over, None if there was none
+        """
+        self.drop_local_changes(replaced)
+        self.attr[self.parent.pop(replaced)]['st_nlink'] -= 1
+        del self.attr[replaced]
+        note = self.notes_ino.pop(replaced, None)
+        if note is None:
+            return None
+        if ino not in self.notes_ino:
+            self.set_note_ino(ino, note)
+            return note
+        self.forget_note(note)
+        self.store.delete_note(note.guid)
+        return None
+
+    def drop_local_changes(self, ino):
+        """
+        forgets the changes of a file being removed, its buffer no longer counts against the content cache
+        """
+        self.upload_queue.cancel(ino)
+        self.writers_release_time.pop(ino, None)
+        self.release_delay.pop(ino, None)
+        self.data.pop(ino, None)
+        self.content_cache.unpin(ino)
+
+    def queue_invalidation(self, ino, name=None):
+        """
+        asks the kernel to drop its cached attributes and data of ino, or the entry name in directory ino.
+
+        Notifications are sent from a sync worker once the tree lock is released: sending one from a
+        request handler, or while a handler waits for the lock, can deadlock with the kernel.
+        """
+        with self.lock:
+            self.invalidations.append((ino, name))
+        self.sync_scheduler.schedule('invalidate', self.send_invalidations, priority=PRIORITY_FOREGROUND)
+
+    def send_invalidations(self):
+        with self.lock:
+            invalidations, self.invalidations = self.invalidations, []
+        for ino, name in invalidations:
+            if name is None:
+                self.notify_inval_inode(ino)
+            else:
+                self.notify_inval_entry(ino, name)
+
+    def schedule_changes_sync(self, delay=0.0):
+        self.sync_scheduler.schedule(
+            'changes', self.sync_changes, delay=delay,
+            period=min(config.NOTEBOOK_SYNC_PERIOD, config.NOTES_SYNC_PERIOD))
+
+    def schedule_notebook_notes_sync(self, notebook_guid, delay=0.0):
+        self.sync_scheduler.schedule(
+            ('notebook', notebook_guid), self.background_sync_notebook_notes, [notebook_guid], delay=delay)
+
+    def schedule_note_sync(self, note_guid, delay=0.0):
+        self.sync_scheduler.schedule(
+            ('note', note_guid), self.background_sync_note, [note_guid],
+            delay=delay, period=config.NOTE_SYNC_PERIOD)
+
+    def remove_notebook_note_from_fuse(self, note):
+        ino = self.note_guid_ino[note.guid]
+        parent = self.parent.get(ino)
+        name = self.child_names.get((parent, ino))
+        if name is None:
+            # its file is no longer in the tree, only the indexes are left
+            self.forget_note(note)
+            return
+
+        self.queue_invalidation(parent, name)
+        self.remove_file(parent, name)
+
+    def remove_file(self, parent, name):
+        """
+        removes a file from the tree and its note from the indexes, the stored note is kept
+        :return: note of the file, None if it is not a note
+        """
+        ino = self.remove_child(parent, name)
         self.attr[parent]['st_nlink'] -= 1
         del self.attr[ino]
+        del self.parent[ino]
+        self.drop_local_changes(ino)
 
-        del self.notes_ino[ino]
-
-    def rename_notebook_note_in_fuse(self, notebook_guid, prev_name, new_name):
-        parent = self.notebook_ino[notebook_guid]
-        self.children[parent][new_name] = self.children[parent][prev_name]
-        del self.children[parent][prev_name]
+        note = self.notes_ino.get(ino)
+        if note is not None:
+            self.forget_note(note)
+        return note
 
-    def add_notebook_note_to_fuse(self, note):
-        ino = self.create_ino()
+    def forget_note(self, note):
+        """
+        removes a note from the indexes and drops its cached content
+        """
+        ino = self.note_guid_ino.pop(note.guid, None)
+        self.notes_ino.pop(ino, None)
+        self.content_cache.pop(note.guid)
+        self.note_sync_time.pop(note.guid, None)
+        self.drop_notebook_note(note)
+
+    def rename_notebook_note_in_fuse(self, prev_note, note):
+        ino = self.note_guid_ino[note.guid]
+        parent = self.parent[ino]
+        self.queue_invalidation(parent, self.child_names[(parent, ino)])
+        self.remove_child(parent, self.child_names[(parent, ino)])
+        if note.notebookGuid != prev_note.notebookGuid:
+            self.attr[parent]['st_nlink'] -= 1
+            parent = self.notebook_ino[note.notebookGuid]
+            self.attr[parent]['st_nlink'] += 1
+            self.parent[ino] = parent
+        self.add_child(parent, note.title, ino)
+        self.queue_invalidation(parent, note.title)
+
+        self.drop_notebook_note(prev_note)
+        self.set_note_ino(ino, note)
+        self.put_notebook_note(note)
+
+    def add_notebook_note_to_fuse(self, note, ino=None):
+        """
+        :param ino: inode of a note restored from the metadata store, a note new to the kernel otherwise
+        """
+        if ino is None:
+            # the kernel may have cached that the name does not exist
+            self.queue_invalidation(self.notebook_ino[note.notebookGuid], note.title)
+        ino = self.create_ino(ino)
         now = time()
         attr = dict(
             st_ino=ino,
@@ -276,32 +980,46 @@ class EvernoteFuse(FUSELL):
         parent = self.notebook_ino[note.notebookGuid]
         self.attr[ino] = attr
         self.attr[parent]['st_nlink'] += 1
-        self.children[parent][note.title] = ino
+        self.add_child(parent, note.title, ino)
         self.parent[ino] = parent
 
-        self.notes_ino[ino] = note
-
-    def add_notebook_notes_to_fuse(self, notebook_guid):
-        notebook_notes = self.notebook_notes[notebook_guid]
-        for note in notebook_notes.values():
-            self.add_notebook_note_to_fuse(note)
+        self.set_note_ino(ino, note)
+        self.put_notebook_note(note)
 
     def rename_notebook_in_fuse(self, prev_name, new_name):
-        self.children[self.root_ino][new_name] = self.children[self.root_ino][prev_name]
-        del self.children[self.root_ino][prev_name]
+        ino = self.remove_child(self.root_ino, prev_name)
+        self.add_child(self.root_ino, new_name, ino)
+        self.queue_invalidation(self.root_ino, prev_name)
+        self.queue_invalidation(self.root_ino, new_name)
 
     def remove_notebook_from_fuse(self, notebook_guid):
         ino = self.notebook_ino[notebook_guid]
-        notebook_name = self.notebooks[notebook_guid].name
+        notebook_name = self.child_names[(self.root_ino, ino)]
+
+        for note in list(self.notebook_notes.pop(notebook_guid, {}).values()):
+            self.notebook_note_titles.pop((notebook_guid, note.title), None)
+            note_ino = self.note_guid_ino.pop(note.guid, None)
+            if note_ino is not None:
+                self.notes_ino.pop(note_ino, None)
 
         del self.notebook_ino[notebook_guid]
-        del self.children[self.root_ino][notebook_name]
+        del self.ino_notebook[ino]
+        self.hydrated_notebooks.discard(notebook_guid)
+        self.remove_child(self.root_ino, notebook_name)
+        self.queue_invalidation(self.root_ino, notebook_name)
         del self.parent[ino]
         self.attr[self.root_ino]['st_nlink'] -= 1
         del self.attr[ino]
 
-    def add_notebook_to_fuse(self, notebook_guid):
-        ino = self.create_ino()
+    def add_notebook_to_fuse(self, notebook_guid, ino=None):
+        """
+        :param ino: inode of a notebook restored from the metadata store, its notes are added by
+                    hydrate_notebook; a new notebook has no stored notes
+        """
+        if ino is None:
+            self.queue_invalidation(self.root_ino, self.notebooks[notebook_guid].name)
+            self.hydrated_notebooks.add(notebook_guid)
+        ino = self.create_ino(ino)
         now = time()
 
         attr = dict(
@@ -320,24 +1038,119 @@ class EvernoteFuse(FUSELL):
         self.attr[ino] = attr
         self.attr[self.root_ino]['st_nlink'] += 1
         self.parent[ino] = self.root_ino
-        self.children[self.root_ino][self.notebooks[notebook_guid].name] = ino
+        self.add_child(self.root_ino, self.notebooks[notebook_guid].name, ino)
 
         self.notebook_ino[notebook_guid] = ino
+        self.ino_notebook[ino] = notebook_guid
+
+    def hydrate_notebook(self, notebook_guid):
+        """
+        adds the stored notes of a notebook restored at mount to the tree, on its first use.
+        It must be called before the notes of the notebook are looked up or changed.
+        """
+        with self.lock:
+            if notebook_guid in self.hydrated_notebooks or notebook_guid not in self.notebook_ino:
+                return
+            snapshot = self.snapshot
+        # notes are decoded without holding the lock, a concurrent hydration of the same notebook is dropped.
+        # The snapshot stays current for notebooks not hydrated yet, their notes are only changed after it.
+        if snapshot is not None:
+            notes = snapshot.get_notebook_notes(notebook_guid)
+        else:
+            notes = self.store.load_notebook_notes(notebook_guid)
+        with self.lock:
+            if notebook_guid in self.hydrated_notebooks or notebook_guid not in self.notebook_ino:
+                return
+            for note, ino, sync_time in notes:
+                self.add_notebook_note_to_fuse(note, ino)
+                if sync_time is not None:
+                    # content itself is loaded on first open
+                    self.note_sync_time[note.guid] = sync_time
+            self.hydrated_notebooks.add(notebook_guid)
+        logging.info('hydrated notebook: ' + self.notebooks[notebook_guid].name + ', ' + str(len(notes)) + ' notes')
+
+    def hydrate_directory(self, ino):
+        notebook_guid = self.ino_notebook.get(ino)
+        if notebook_guid is not None and notebook_guid not in self.hydrated_notebooks:
+            self.hydrate_notebook(notebook_guid)
+
+    def hydrate_note(self, note_guid):
+        """
+        hydrates the notebook a stored note is in, if it is not in the tree yet
+        """
+        if self.get_note_ino(note_guid) is None:
+            notebook_guid = self.store.get_note_notebook_guid(note_guid)
+            if notebook_guid is not None:
+                self.hydrate_notebook(notebook_guid)
 
     def get_notebook_by_ino(self, ino):
-        for notebook_guid, notebook_ino in self.notebook_ino.items():
-            if notebook_ino == ino:
-                return self.notebooks[notebook_guid]
-        raise AssertionError("Notebook with ino not found: " + ino)
+        if ino not in self.ino_notebook:
+            raise AssertionError("Notebook with ino not found: " + str(ino))
+        return self.notebooks[self.ino_notebook[ino]]
 
     def find_child_by_parent_and_ino(self, parent, ino):
-        for child_name, child_ino in self.children[parent].items():
-            if child_ino == ino:
-                return child_name
+        return self.child_names.get((parent, ino))
 
-    def create_ino(self):
-        self.ino += 1
-        return self.ino
+    def add_child(self, parent, name, ino):
+        self.children[parent][name] = ino
+        self.child_names[(parent, ino)] = name
+        self.dir_generation[parent] += 1
+
+    def remove_child(self, parent, name):
+        ino = self.children[parent].pop(name)
+        self.child_names.pop((parent, ino), None)
+        self.dir_generation[parent] += 1
+        return ino
+
+    def add_stats_file(self, name, render):
+        """
+        adds a read-only file to the mount root, rendered by render(sections) whenever it is read from the start
+        """
+        ino = self.create_ino()
+        with self.lock:
+            self.attr[ino] = dict(
+                st_ino=ino,
+                st_mode=S_IFREG | 0o444,
+                st_nlink=1,
+                st_mtime=time())
+            self.parent[ino] = self.root_ino
+            self.add_child(self.root_ino, name, ino)
+            self.stats_files[ino] = render
+
+    def get_stats_sections(self):
+        with self.lock:
+            sections = [
+                ('content_cache', self.content_cache.get_stats()),
+                ('prefetch', dict(self.prefetch_stats))]
+        return sections + [
+            ('uploads', self.upload_queue.get_stats()),
+            ('api', self.api.get_stats()),
+            ('profiler', self.profiler.get_stats())]
+
+    def get_stats_file_content(self, ino, off):
+        """
+        a read from the start renders the file again, later reads continue the same snapshot
+        """
+        with self.lock:
+            content = self.stats_snapshots.get(ino)
+        if off == 0 or content is None:
+            content = self.stats_files[ino](self.get_stats_sections()).encode('utf-8')
+            with self.lock:
+                self.stats_snapshots[ino] = content
+                self.attr[ino]['st_size'] = len(content)
+                self.attr[ino]['st_mtime'] = time()
+        return content
+
+    def create_ino(self, ino=None):
+        """
+        :param ino: inode number persisted for this object before, to keep it stable across mounts
+        """
+        with self.lock:
+            if ino is not None:
+                self.ino = max(self.ino, ino)
+                return ino
+            self.ino += 1
+            return self.ino
 
     def init(self, userdata, conn):
         self.attr[1] = dict(
@@ -346,33 +1159,61 @@ class EvernoteFuse(FUSELL):
             st_nlink=2)
         self.parent[1] = 1
 
-        for notebook_guid in self.notebooks:
-            self.add_notebook_to_fuse(notebook_guid)
-            if notebook_guid in self.notebook_notes:
-                self.add_notebook_notes_to_fuse(notebook_guid)
+        # inodes of notes not loaded yet stay reserved, so they are stable across mounts
+        self.create_ino(self.store.get_max_ino())
+        self.snapshot = self.open_snapshot()
+        restored = self.snapshot.get_notebooks() if self.snapshot is not None else self.store.load_notebooks()
+        for notebook, ino, notes_sync_time in restored:
+            self.notebooks[notebook.guid] = notebook
+            self.add_notebook_to_fuse(notebook.guid, ino)
+            if notes_sync_time is not None:
+                self.notebooks_notes_sync_time[notebook.guid] = notes_sync_time
+
+        if not config.LAZY_TREE:
+            for notebook_guid in list(self.notebooks):
+                self.hydrate_notebook(notebook_guid)
+
+        if config.STATS_FILE:
+            self.add_stats_file(config.STATS_FILE, self.metrics.render_text)
+        if config.STATS_PROMETHEUS_FILE:
+            self.add_stats_file(config.STATS_PROMETHEUS_FILE, self.metrics.render_prometheus)
 
-        self.sync_notebooks()
+        self.sync_scheduler.schedule(
+            'compaction', self.compact_contents, delay=CONTENTS_COMPACTION_PERIOD, period=CONTENTS_COMPACTION_PERIOD)
+
+        if self.notebooks:
+            # serve the persisted tree right away and catch up with changes in background
+            self.schedule_changes_sync()
+        else:
+            try:
+                self.sync_scheduler.run('changes', self.sync_changes, [API_FOREGROUND])
+                self.schedule_changes_sync(min(config.NOTEBOOK_SYNC_PERIOD, config.NOTES_SYNC_PERIOD))
+            except RateLimited as e:
+                logging.warning('init: ' + str(e) + ', the mount stays empty until then')
+                self.schedule_changes_sync(e.retry_after)
 
         logging.info('init done')
 
     def getattr(self, req, ino, fi):
-        attr = self.attr[ino]
+        with self.lock:
+            attr = dict(self.attr.get(ino, {}))
         if attr:
-            self.reply_attr(req, attr, 1.0)
+            self.reply_attr(req, attr, config.ATTR_TIMEOUT)
         else:
             self.reply_err(req, ENOENT)
 
     def lookup(self, req, parent, name):
-        children = self.children[parent]
-        ino = children.get(name, 0)
-        attr = self.attr[ino]
+        self.hydrate_directory(parent)
+        with self.lock:
+            ino = self.children[parent].get(name, 0)
+            attr = dict(self.attr.get(ino, {}))
 
         if attr:
             entry = dict(
                 ino=ino,
                 attr=attr,
-                attr_timeout=1.0,
-                entry_timeout=1.0)
+                attr_timeout=config.ATTR_TIMEOUT,
+                entry_timeout=config.ENTRY_TIMEOUT)
             self.reply_entry(req, entry)
         else:
             self.reply_err(req, ENOENT)
@@ -391,16 +1232,17 @@ class EvernoteFuse(FUSELL):
             st_mtime=now,
             st_ctime=now)
 
-        self.attr[ino] = attr
-        self.attr[parent]['st_nlink'] += 1
-        self.parent[ino] = parent
-        self.children[parent][name] = ino
+        with self.lock:
+            self.attr[ino] = attr
+            self.attr[parent]['st_nlink'] += 1
+            self.parent[ino] = parent
+            self.add_child(parent, name, ino)
 
         entry = dict(
             ino=ino,
-            attr=attr,
-            attr_timeout=1.0,
-            entry_timeout=1.0)
+            attr=dict(attr),
+            attr_timeout=config.ATTR_TIMEOUT,
+            entry_timeout=config.ENTRY_TIMEOUT)
         self.reply_entry(req, entry)
 
     def mknod(self, req, parent, name, mode, rdev):
@@ -418,118 +1260,262 @@ class EvernoteFuse(FUSELL):
             st_mtime=now,
             st_ctime=now)
 
-        self.attr[ino] = attr
-        self.attr[parent]['st_nlink'] += 1
-        self.children[parent][name] = ino
-        self.parent[ino] = parent
+        with self.lock:
+            self.attr[ino] = attr
+            self.attr[parent]['st_nlink'] += 1
+            self.add_child(parent, name, ino)
+            self.parent[ino] = parent
 
         entry = dict(
             ino=ino,
-            attr=attr,
-            attr_timeout=1.0,
-            entry_timeout=1.0)
+            attr=dict(attr),
+            attr_timeout=config.ATTR_TIMEOUT,
+            entry_timeout=config.ENTRY_TIMEOUT)
         self.reply_entry(req, entry)
 
     def open(self, req, ino, fi):
-        if ino in self.notes_ino:
-            self.sync_note(self.notes_ino[ino])
+        if ino in self.stats_files:
+            if fi['flags'] & O_ACCMODE != O_RDONLY:
+                self.reply_err(req, EACCES)
+                return
+            # its size is only known once it is rendered
+            fi['direct_io'] = 1
+            self.reply_open(req, fi)
+            return
+
+        with self.lock:
+            note = self.notes_ino.get(ino)
+            if note is not None:
+                self.note_open_time[note.guid] = time()
+                if note.guid not in self.content_cache and note.guid in self.note_sync_time:
+                    self.load_note_content(ino, note)
+                serve_stale = self.should_sync_note(note) and self.can_serve_stale_note(ino, note)
+        if note is not None:
+            if serve_stale:
+                with self.lock:
+                    self.prefetch_stats['stale'] += 1
+                self.sync_scheduler.schedule(
+                    ('note', note.guid), self.background_sync_note, [note.guid],
+                    priority=PRIORITY_FOREGROUND, period=config.NOTE_SYNC_PERIOD)
+            elif self.should_sync_note(note):
+                # the note is fetched without holding the lock, other requests are served meanwhile
+                with self.lock:
+                    self.prefetch_stats['misses'] += 1
+                try:
+                    self.sync_scheduler.run(('note', note.guid), self.sync_note, [note, API_FOREGROUND])
+                    with self.lock:
+                        joined_failed = self.should_sync_note(note)
+                    if joined_failed:
+                        # the run joined a prefetch that was shed or failed, the note is fetched here instead
+                        self.sync_scheduler.run(('note', note.guid), self.sync_note, [note, API_FOREGROUND])
+                    with self.lock:
+                        stored = not self.should_sync_note(note) or note.guid in self.content_cache or ino in self.data
+                    if not stored:
+                        # the second run joined another fetch of the note that failed as well
+                        self.reply_err(req, EAGAIN)
+                        return
+                except RateLimited as e:
+                    with self.lock:
+                        stored = note.guid in self.content_cache or ino in self.data
+                    if not stored:
+                        self.reply_err(req, EAGAIN)
+                        return
+                    # serve the stored copy, it is refreshed once the limit passes
+                    logging.info('open: ' + str(e) + ', serving stored ' + note.title)
+            else:
+                with self.lock:
+                    if note.guid in self.prefetched:
+                        self.prefetch_stats['hits'] += 1
+                        self.prefetched.discard(note.guid)
+            self.schedule_note_sync(note.guid, self.note_sync_time.get(note.guid, 0) + config.NOTE_SYNC_PERIOD - time())
+        if fi['flags'] & O_ACCMODE != O_RDONLY:
+            with self.lock:
+                self.open_writer(ino)
         self.reply_open(req, fi)
 
-    def read(self, req, ino, size, off, fi):
-        buf = self.data[ino][off:(off + size)]
-        self.reply_buf(req, buf)
+    def release(self, req, ino, fi):
+        if fi['flags'] & O_ACCMODE != O_RDONLY:
+            with self.lock:
+                self.release_writer(ino)
+        self.reply_err(req, 0)
 
-    def readdir(self, req, ino, size, off, fi):
-        parent = self.parent[ino]
-        entries = [
-            ('.', {'st_ino': ino, 'st_mode': S_IFDIR}),
-            ('..', {'st_ino': parent, 'st_mode': S_IFDIR})]
+    def fsync(self, req, ino, datasync, fi):
+        # waits for the upload, not holding the lock
+        self.reply_err(req, 0 if self.upload_queue.flush(ino) else EIO)
+
+    def read(self, req, ino, size, off, fi):
+        if ino in self.stats_files:
+            self.reply_buf(req, self.get_stats_file_content(ino, off)[off:(off + size)])
+            return
 
-        if ino in self.notebook_ino.values():
-            self.sync_notebook_notes(self.get_notebook_by_ino(ino))
+        with self.lock:
+            content = self.get_note_content(ino)
+            if isinstance(content, bytearray):
+                # buffer being edited may be resized by the next write, so it can not be lent out
+                content = bytes(memoryview(content)[off:(off + size)])
+            else:
+                content = content[off:(off + size)]
+        self.metrics.incr('read_bytes', len(content))
+        self.reply_buf(req, content)
 
-        for name, child in self.children[ino].items():
-            entries.append((name, self.attr[child]))
+    def refresh_directory(self, ino, off):
+        """
+        syncs the notes of a notebook before it is listed
+        """
+        self.hydrate_directory(ino)
+        with self.lock:
+            notebook = self.get_notebook_by_ino(ino) if ino in self.ino_notebook else None
+
+        if notebook is not None:
+            if self.should_sync_notebook_notes(notebook):
+                try:
+                    self.sync_scheduler.run(
+                        ('notebook', notebook.guid), self.sync_notebook_notes, [notebook, API_FOREGROUND])
+                except RateLimited as e:
+                    # list the stored notes, they are synced once the limit passes
+                    logging.info('readdir: ' + str(e) + ', listing stored ' + notebook.name)
+                    self.schedule_notebook_notes_sync(notebook.guid, e.retry_after)
+            if off == 0 and config.PREFETCH_NOTEBOOK_BUDGET > 0:
+                self.prefetch_notebook_notes(notebook.guid)
+
+    def list_directory(self, ino):
+        """
+        :return: list of (name, ino, attr) including '.' and '..'
+        """
+        self.hydrate_directory(ino)
+        with self.lock:
+            parent = self.parent[ino]
+            entries = [
+                ('.', ino, dict(self.attr[ino])),
+                ('..', parent, dict(self.attr[parent]))]
+            for name, child in self.children[ino].items():
+                entries.append((name, child, dict(self.attr[child])))
+        return entries
+
+    def get_dir_buffer(self, ino):
+        """
+        :return: packed entries of a directory, shared by its listings until a child is added or removed
+        """
+        with self.lock:
+            generation = self.dir_generation[ino]
+            cached = self.dir_buffers.get(ino)
+            if cached is not None and cached[0] == generation:
+                return cached[1]
+            entries = self.list_directory(ino)
+
+        buf = self.pack_dirents([(name, attr) for name, child, attr in entries])
+        with self.lock:
+            self.dir_buffers[ino] = (generation, buf)
+        return buf
+
+    def opendir(self, req, ino, fi):
+        fi['fh'] = next(self.dir_handle_seq)
+        self.reply_open(req, fi)
 
-        self.reply_readdir(req, size, off, entries)
+    def readdir(self, req, ino, size, off, fi):
+        fh = fi.get('fh')
+        with self.lock:
+            handle = self.dir_handles.get(fh)
+        if off == 0 or handle is None:
+            # a listing keeps the snapshot taken when it started, so offsets stay valid while it goes on
+            self.refresh_directory(ino, off)
+            handle = (ino, self.get_dir_buffer(ino))
+            if fh is not None:
+                with self.lock:
+                    self.dir_handles[fh] = handle
+        self.reply_dirents(req, size, off, handle[1])
+
+    def releasedir(self, req, ino, fi):
+        with self.lock:
+            self.dir_handles.pop(fi.get('fh'), None)
+            if not any(handle[0] == ino for handle in self.dir_handles.values()):
+                self.dir_buffers.pop(ino, None)
+        self.reply_err(req, 0)
 
     def rename(self, req, parent, name, newparent, newname):
-        ino = self.children[parent].pop(name)
-        self.children[newparent][newname] = ino
-        self.parent[ino] = newparent
-
-        if not newname.startswith('.'):
-            if ino in self.note_rename_timers:
-                self.note_rename_timers[ino].cancel()
-            timer = Timer(NOTE_UPDATE_DELAY, self.rename_note, [ino])
-            timer.daemon = True
-            timer.start()
-            self.note_rename_timers[ino] = timer
+        with self.lock:
+            if self.children[parent].get(name) in self.stats_files or \
+                    self.children[newparent].get(newname) in self.stats_files:
+                self.reply_err(req, EPERM)
+                return
+            ino = self.remove_child(parent, name)
+            replaced_note = None
+            if newname in self.children[newparent]:
+                replaced_note = self.replace_ino(self.remove_child(newparent, newname), ino)
+            if parent != newparent:
+                self.attr[parent]['st_nlink'] -= 1
+                self.attr[newparent]['st_nlink'] += 1
+            self.add_child(newparent, newname, ino)
+            self.parent[ino] = newparent
+
+            if replaced_note is not None and not newname.startswith('.'):
+                # an editor saved the note through a temporary file, its content updates the note
+                delay = NOTE_UPDATE_DELAY if self.writers.get(ino) else self.release_delay.get(ino, NOTE_RELEASE_DELAY)
+                self.upload_queue.add(ino, 'update', delay)
+            elif not newname.startswith('.'):
+                self.upload_queue.add(ino, 'rename', NOTE_UPDATE_DELAY)
 
         self.reply_err(req, 0)
 
     def setattr(self, req, ino, attr, to_set, fi):
-        a = self.attr[ino]
-        for key in to_set:
-            if key == 'st_mode':
-                # Keep the old file type bit fields
-                a['st_mode'] = S_IFMT(a['st_mode']) | S_IMODE(attr['st_mode'])
-            else:
-                a[key] = attr[key]
-        self.attr[ino] = a
-        self.reply_attr(req, a, 1.0)
-
-    def write(self, req, ino, buf, off, fi):
-        self.data[ino] = self.data[ino][:off] + buf
-        self.attr[ino]['st_size'] = len(self.data[ino])
+        if ino in self.stats_files:
+            self.reply_err(req, EPERM)
+            return
 
-        parent = self.parent[ino]
-        note_name = self.find_child_by_parent_and_ino(parent, ino)
-        notebook_guid = self.get_notebook_by_ino(parent).guid
-        note = self.find_note_by_name(notebook_guid, note_name)
-        if not note_name.startswith('.'):
-            if note is None:
-                if ino in self.note_creation_timers:
-                    self.note_creation_timers[ino].cancel()
-                timer = Timer(NOTE_CREATION_DELAY, self.create_note, [ino])
-                timer.daemon = True
-                timer.start()
-                self.note_creation_timers[ino] = timer
-            else:
-                if ino in self.note_update_timers:
-                    self.note_update_timers[ino].cancel()
-                timer = Timer(NOTE_UPDATE_DELAY, self.update_note, [ino])
-                timer.daemon = True
-                timer.start()
-                self.note_update_timers[ino] = timer
+        with self.lock:
+            a = self.attr[ino]
+            for key in to_set:
+                if key == 'st_mode':
+                    # Keep the old file type bit fields
+                    a['st_mode'] = S_IFMT(a['st_mode']) | S_IMODE(attr['st_mode'])
+                elif key == 'st_size':
+                    data = self.get_write_buffer(ino)
+                    if attr['st_size'] < len(data):
+                        del data[attr['st_size']:]
+                    else:
+                        data.extend(b'\0' * (attr['st_size'] - len(data)))
+                    a['st_size'] = attr['st_size']
+                    self.pin_content(ino)
+                    self.queue_content_upload(ino)
+                else:
+                    a[key] = attr[key]
+            self.attr[ino] = a
+            a = dict(a)
+        self.reply_attr(req, a, config.ATTR_TIMEOUT)
 
+    def write(self, req, ino, buf, off, fi):
+        with self.lock:
+            data = self.get_write_buffer(ino)
+            if off > len(data):
+                # sparse write, fill the hole with zeros
+                data.extend(b'\0' * (off - len(data)))
+            data[off:off + len(buf)] = buf
+            self.attr[ino]['st_size'] = len(data)
+            self.pin_content(ino)
+            self.queue_content_upload(ino)
+
+        self.metrics.incr('write_bytes', len(buf))
         self.reply_write(req, len(buf))
 
     def rmdir(self, req, parent, name):
-        ino = self.children[parent][name]
+        with self.lock:
+            ino = self.remove_child(parent, name)
 
-        del self.children[parent][name]
-        del self.parent[ino]
-        self.attr[parent]['st_nlink'] -= 1
-        del self.attr[ino]
+            del self.parent[ino]
+            self.attr[parent]['st_nlink'] -= 1
+            del self.attr[ino]
 
         self.reply_err(req, 0)
 
     def unlink(self, req, parent, name):
-        ino = self.children[parent][name]
-
-        if ino in self.note_creation_timers:
-            self.note_creation_timers[ino].cancel()
-            del self.note_creation_timers[ino]
-        if ino in self.note_update_timers:
-            self.note_update_timers[ino].cancel()
-            del self.note_update_timers[ino]
-        if ino in self.note_rename_timers:
-            self.note_rename_timers[ino].cancel()
-            del self.note_rename_timers[ino]
-
-        del self.children[parent][name]
-        self.attr[parent]['st_nlink'] -= 1
-        del self.attr[ino]
+        with self.lock:
+            ino = self.children[parent][name]
+            if ino in self.stats_files:
+                self.reply_err(req, EPERM)
+                return
+            note = self.remove_file(parent, name)
+            if note is not None:
+                # the note is not deleted from Evernote, it is listed again once it changes there
+                self.store.delete_note(note.guid)
 
         self.reply_err(req, 0)
@@ -22,6 +22,7 @@ from ctypes.util import find_library
 from platform import machine, system
 from signal import signal, SIGINT, SIG_DFL
 from stat import S_IFDIR
+from threading import local
 
 
 _system = system()
@@ -43,6 +44,9 @@ if not _libfuse_path:
 else:
     _libfuse = ctypes.CDLL(_libfuse_path)
 
+# write_buf needs fuse_buf_copy, libfuse 2.9 and later
+_has_write_buf = hasattr(_libfuse, 'fuse_buf_copy')
+
 class LibFUSE(ctypes.CDLL):
     def __init__(self):
         if _system == 'Darwin':
@@ -63,6 +67,7 @@ class LibFUSE(ctypes.CDLL):
         self.fuse_session_add_chan.argtypes = (
             ctypes.c_void_p, ctypes.c_void_p)
         self.fuse_session_loop.argtypes = (ctypes.c_void_p,)
+        self.fuse_session_loop_mt.argtypes = (ctypes.c_void_p,)
         self.fuse_remove_signal_handlers.argtypes = (ctypes.c_void_p,)
         self.fuse_session_remove_chan.argtypes = (ctypes.c_void_p,)
         self.fuse_session_destroy.argtypes = (ctypes.c_void_p,)
@@ -83,10 +88,22 @@ class LibFUSE(ctypes.CDLL):
         self.fuse_reply_readlink.argtypes = (
             fuse_req_t, ctypes.c_char_p)
 
+        self.fuse_lowlevel_notify_inval_inode.argtypes = (
+            ctypes.c_void_p, fuse_ino_t, c_off_t, c_off_t)
+        self.fuse_lowlevel_notify_inval_entry.argtypes = (
+            ctypes.c_void_p, fuse_ino_t, ctypes.c_char_p, ctypes.c_size_t)
+
         self.fuse_add_direntry.argtypes = (
             ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t,
             ctypes.c_char_p, c_stat_p, c_off_t)
 
+        if _has_write_buf:
+            self.fuse_buf_size.argtypes = (ctypes.POINTER(fuse_bufvec),)
+            self.fuse_buf_size.restype = ctypes.c_size_t
+            self.fuse_buf_copy.argtypes = (
+                ctypes.POINTER(fuse_bufvec), ctypes.POINTER(fuse_bufvec), ctypes.c_int)
+            self.fuse_buf_copy.restype = ctypes.c_ssize_t
+
 class fuse_args(ctypes.Structure):
     _fields_ = [
         ('argc', ctypes.c_int),
@@ -279,6 +296,29 @@ fuse_forget_data_p = ctypes.POINTER(fuse_forget_data)
 
 FUSE_SET_ATTR = ('st_mode', 'st_uid', 'st_gid', 'st_size', 'st_atime', 'st_mtime')
 
+class fuse_buf(ctypes.Structure):
+    _fields_ = [
+        ('size', ctypes.c_size_t),
+        ('flags', ctypes.c_int),
+        ('mem', ctypes.c_void_p),
+        ('fd', ctypes.c_int),
+        ('pos', c_off_t),
+    ]
+
+class fuse_bufvec(ctypes.Structure):
+    _fields_ = [
+        ('count', ctypes.c_size_t),
+        ('idx', ctypes.c_size_t),
+        ('off', ctypes.c_size_t),
+        ('buf', fuse_buf * 1),
+    ]
+
+FUSE_NAME_OFFSET = 24  # ino, off, namelen and type of struct fuse_dirent
+
+def fuse_dirent_size(namelen):
+    # FUSE_DIRENT_ALIGN(FUSE_NAME_OFFSET + namelen), what fuse_add_direntry returns
+    return (FUSE_NAME_OFFSET + namelen + 7) & ~7
+
 class fuse_entry_param(ctypes.Structure):
     _fields_ = [
         ('ino', fuse_ino_t),
@@ -466,8 +506,15 @@ def setattr_mask_to_list(mask):
 
 class FUSELL(object):
     use_ns = False
+    chan = None
 
-    def __init__(self, mountpoint, encoding='utf-8'):
+    def __init__(self, mountpoint, encoding='utf-8', multithreaded=False):
+        """
+        Mounts the filesystem and serves requests until it is unmounted.
+
+        :param multithreaded: dispatch requests from the worker threads of fuse_session_loop_mt,
+                              handlers may then run concurrently and must do their own locking
+        """
         if not self.use_ns:
             warnings.warn(
                 'Time as floating point seconds for utimens is deprecated!\n'
@@ -478,13 +525,16 @@ class FUSELL(object):
 
         self.libfuse = LibFUSE()
         self.encoding = encoding
+        self.write_buffers = local()
 
         fuse_ops = fuse_lowlevel_ops()
 
         for name, prototype in fuse_lowlevel_ops._fields_:
+            if name == 'write_buf' and not _has_write_buf:
+                continue
             method = getattr(self, 'fuse_' + name, None) or getattr(self, name, None)
             if method:
-                setattr(fuse_ops, name, prototype(method))
+                setattr(fuse_ops, name, prototype(self.instrument(name, method)))
 
         args = ['fuse']
         argv = fuse_args(len(args), (ctypes.c_char_p * len(args))(*[arg.encode(self.encoding) for arg in args]), 0)
@@ -507,8 +557,12 @@ class FUSELL(object):
         assert err == 0
 
         self.libfuse.fuse_session_add_chan(session, chan)
+        self.chan = chan
 
-        err = self.libfuse.fuse_session_loop(session)
+        if multithreaded:
+            err = self.libfuse.fuse_session_loop_mt(session)
+        else:
+            err = self.libfuse.fuse_session_loop(session)
         assert err == 0
 
         err = self.libfuse.fuse_remove_signal_handlers(session)
@@ -519,10 +573,30 @@ class FUSELL(object):
         except ValueError:
             pass
 
+        self.chan = None
         self.libfuse.fuse_session_remove_chan(chan)
         self.libfuse.fuse_session_destroy(session)
         self.libfuse.fuse_unmount(mountpoint.encode(encoding), chan)
 
+    def notify_inval_inode(self, ino, off=0, length=0):
+        """
+        drops cached data of an inode from the kernel, length 0 drops everything from off.
+        Must not be called from a handler of a request for the same inode.
+        """
+        if self.chan is None:
+            return -errno.ENOTCONN
+        return self.libfuse.fuse_lowlevel_notify_inval_inode(self.chan, ino, off, length)
+
+    def notify_inval_entry(self, parent, name):
+        """
+        drops the cached lookup of name in directory parent from the kernel.
+        Must not be called from a request handler.
+        """
+        if self.chan is None:
+            return -errno.ENOTCONN
+        name = name.encode(self.encoding)
+        return self.libfuse.fuse_lowlevel_notify_inval_entry(self.chan, parent, name, len(name))
+
     def reply_err(self, req, err):
         return self.libfuse.fuse_reply_err(req, err)
 
@@ -554,27 +628,56 @@ class FUSELL(object):
         return self.libfuse.fuse_reply_write(req, count)
 
     def reply_buf(self, req, buf):
-        return self.libfuse.fuse_reply_buf(req, buf, len(buf))
+        """
+        :param buf: bytes, or an object with the buffer protocol (bytearray, memoryview of a mmap)
+                    whose memory is passed to libfuse without a copy if it is writable
+        """
+        if isinstance(buf, bytes):
+            return self.libfuse.fuse_reply_buf(req, buf, len(buf))
+
+        view = memoryview(buf)
+        if not view.nbytes:
+            return self.libfuse.fuse_reply_buf(req, None, 0)
+        if view.readonly:
+            return self.libfuse.fuse_reply_buf(req, view.tobytes(), view.nbytes)
+        with view:
+            data = (ctypes.c_char * view.nbytes).from_buffer(view)
+            err = self.libfuse.fuse_reply_buf(req, data, view.nbytes)
+            del data
+        return err
 
     def reply_readdir(self, req, size, off, entries):
-        bufsize = 0
-        sized_entries = []
-        for name, attr in entries:
-            name = name.encode(self.encoding)
-            entsize = self.libfuse.fuse_add_direntry(req, None, 0, name, None, 0)
-            sized_entries.append((name, attr, entsize))
-            bufsize += entsize
+        return self.reply_dirents(req, size, off, self.pack_dirents(entries))
+
+    def pack_dirents(self, entries):
+        """
+        Packs directory entries once, so that a listing can be replied from the same buffer
+        with reply_dirents until the directory changes. Offsets are byte positions in the buffer.
+
+        :param entries: list of (name, attr), only st_ino and the file type in st_mode are used
+        :return: ctypes buffer
+        """
+        names = [name.encode(self.encoding) for name, attr in entries]
+        buf = ctypes.create_string_buffer(sum(fuse_dirent_size(len(name)) for name in names))
+        address = ctypes.addressof(buf)
+        st = c_stat()
 
         next = 0
-        buf = ctypes.create_string_buffer(bufsize)
-        for name, attr, entsize in sized_entries:
-            entbuf = ctypes.cast(
-                ctypes.addressof(buf) + next, ctypes.c_char_p)
-            st = c_stat(**attr)
+        for name, (_, attr) in zip(names, entries):
+            entsize = fuse_dirent_size(len(name))
+            entbuf = ctypes.cast(address + next, ctypes.c_char_p)
+            st.st_ino = attr['st_ino']
+            st.st_mode = attr['st_mode']
             next += entsize
             self.libfuse.fuse_add_direntry(
-                req, entbuf, entsize, name, ctypes.byref(st), next)
+                None, entbuf, entsize, name, ctypes.byref(st), next)
+        return buf
 
+    def reply_dirents(self, req, size, off, buf):
+        """
+        :param buf: entries packed with pack_dirents
+        """
+        bufsize = len(buf)
         if off < bufsize:
             buf = ctypes.cast(
                 ctypes.addressof(buf) + off, ctypes.c_char_p) if off else buf
@@ -630,6 +733,26 @@ class FUSELL(object):
         fi_dict = struct_to_dict(fi)
         self.write(req, ino, buf_str, off, fi_dict)
 
+    def fuse_write_buf(self, req, ino, bufv, off, fi):
+        # used instead of fuse_write: data is copied once, straight into a buffer reused by this thread
+        src = ctypes.cast(bufv, ctypes.POINTER(fuse_bufvec))
+        size = self.libfuse.fuse_buf_size(src)
+
+        buf = getattr(self.write_buffers, 'buf', None)
+        if buf is None or len(buf) < size:
+            buf = self.write_buffers.buf = bytearray(size)
+        mem = (ctypes.c_char * len(buf)).from_buffer(buf)
+        dst = fuse_bufvec(count=1, idx=0, off=0)
+        dst.buf[0].size = size
+        dst.buf[0].mem = ctypes.addressof(mem)
+        copied = self.libfuse.fuse_buf_copy(ctypes.byref(dst), src, 0)
+        del mem
+
+        if copied < 0:
+            return self.reply_err(req, -copied)
+        with memoryview(buf) as view, view[:copied] as data:
+            self.write(req, ino, data, off, struct_to_dict(fi))
+
     def fuse_flush(self, req, ino, fi):
         self.flush(req, ino, struct_to_dict(fi))
 
@@ -637,7 +760,7 @@ class FUSELL(object):
         self.release(req, ino, struct_to_dict(fi))
 
     def fuse_fsync(self, req, ino, datasync, fi):
-        self.fsyncdir(req, ino, datasync, struct_to_dict(fi))
+        self.fsync(req, ino, datasync, struct_to_dict(fi))
 
     def fuse_opendir(self, req, ino, fi):
         self.opendir(req, ino, struct_to_dict(fi))
@@ -665,6 +788,15 @@ class FUSELL(object):
 
     # Utility methods
 
+    def instrument(self, name, method):
+        """
+        Called once per operation before mounting, subclasses may wrap the methods libfuse calls.
+
+        :param name: operation name, e.g. 'lookup'
+        :return: method to be called for the operation
+        """
+        return method
+
     def req_ctx(self, req):
         ctx = self.libfuse.fuse_req_ctx(req)
         return struct_to_dict(ctx)
@@ -816,6 +948,9 @@ class FUSELL(object):
     def write(self, req, ino, buf, off, fi):
         """Write data
 
+        buf is bytes, or a memoryview when received through write_buf,
+        and is only valid until write() returns
+
         Valid replies:
             reply_write
             reply_err
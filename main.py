@@ -7,6 +7,7 @@ import getpass
 from evernote.api.client import EvernoteClient
 
 import config
+from simulated_note_store import SimulatedEvernoteClient, SimulatedNoteStore
 
 EVERNOTE_TOKEN_FILE = '.evernote_token'
 OAUTH_URL = 'http://localhost'
@@ -17,7 +18,10 @@ def main():
     if not mount_point_exists():
         mount_point_create()
 
-    client = EvernoteClient(token=get_evernote_token())
+    if config.BACKEND == 'simulated':
+        client = SimulatedEvernoteClient(SimulatedNoteStore(**config.SIMULATED_NOTE_STORE))
+    else:
+        client = EvernoteClient(token=get_evernote_token())
     fusepass.EvernoteFuse(config.MOUNT_POINT, client)
 
 
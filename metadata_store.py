@@ -0,0 +1,199 @@
+from __future__ import print_function, absolute_import, division
+
+from contextlib import contextmanager
+from threading import RLock
+import pickle
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS notebooks (
+    guid TEXT PRIMARY KEY,
+    ino INTEGER NOT NULL,
+    notes_sync_time REAL,
+    notebook BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS notes (
+    guid TEXT PRIMARY KEY,
+    notebook_guid TEXT NOT NULL,
+    ino INTEGER NOT NULL,
+    sync_time REAL,
+    note BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notes_notebook ON notes (notebook_guid);
+CREATE INDEX IF NOT EXISTS notes_ino ON notes (ino);
+CREATE TABLE IF NOT EXISTS content_index (
+    guid TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+'''
+
+
+class MetadataStore(object):
+
+    def __init__(self, db_path):
+        """
+        Notebooks, note metadata, sync times, the inode map and the note content index, kept in SQLite.
+
+        Every change is written as it happens, so the process can be killed at any time
+        without losing more than the change in progress.
+        """
+        self.lock = RLock()
+        self.depth = 0
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    @contextmanager
+    def transaction(self):
+        """
+        groups writes into one commit, nested transactions are committed by the outermost one
+        """
+        with self.lock:
+            self.depth += 1
+            try:
+                yield self.connection
+            except Exception:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.connection.rollback()
+                raise
+            self.depth -= 1
+            if self.depth == 0:
+                self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get_state(self, key, default=None):
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_state(self, key, value):
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value))
+
+    def put_notebook(self, notebook, ino):
+        with self.transaction() as db:
+            db.execute(
+                'INSERT INTO notebooks (guid, ino, notebook) VALUES (?, ?, ?) '
+                'ON CONFLICT (guid) DO UPDATE SET ino = excluded.ino, notebook = excluded.notebook',
+                (notebook.guid, ino, pickle.dumps(notebook, 2)))
+
+    def set_notebook_notes_sync_time(self, notebook_guid, sync_time):
+        with self.transaction() as db:
+            db.execute('UPDATE notebooks SET notes_sync_time = ? WHERE guid = ?', (sync_time, notebook_guid))
+
+    def set_notebooks_notes_sync_time(self, sync_time):
+        with self.transaction() as db:
+            db.execute('UPDATE notebooks SET notes_sync_time = ? WHERE notes_sync_time IS NOT NULL', (sync_time,))
+
+    def clear_notebooks_notes_sync_time(self):
+        with self.transaction() as db:
+            db.execute('UPDATE notebooks SET notes_sync_time = NULL')
+
+    def delete_notebook(self, notebook_guid):
+        with self.transaction() as db:
+            db.execute(
+                'DELETE FROM content_index WHERE guid IN (SELECT guid FROM notes WHERE notebook_guid = ?)',
+                (notebook_guid,))
+            db.execute('DELETE FROM notes WHERE notebook_guid = ?', (notebook_guid,))
+            db.execute('DELETE FROM notebooks WHERE guid = ?', (notebook_guid,))
+
+    def load_notebooks(self):
+        """
+        :return: list of (notebook, ino, notes_sync_time)
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT notebook, ino, notes_sync_time FROM notebooks').fetchall()
+        return [(pickle.loads(notebook), ino, notes_sync_time) for notebook, ino, notes_sync_time in rows]
+
+    def put_note(self, note, ino):
+        with self.transaction() as db:
+            db.execute(
+                'INSERT INTO notes (guid, notebook_guid, ino, note) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (guid) DO UPDATE SET '
+                'notebook_guid = excluded.notebook_guid, ino = excluded.ino, note = excluded.note',
+                (note.guid, note.notebookGuid, ino, pickle.dumps(note, 2)))
+
+    def put_note_content(self, note_guid, offset, length, sync_time):
+        """
+        :param offset: where the content was appended in the content segment
+        """
+        with self.transaction() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO content_index (guid, offset, length) VALUES (?, ?, ?)',
+                (note_guid, offset, length))
+            db.execute('UPDATE notes SET sync_time = ? WHERE guid = ?', (sync_time, note_guid))
+
+    def set_note_sync_time(self, note_guid, sync_time):
+        with self.transaction() as db:
+            db.execute('UPDATE notes SET sync_time = ? WHERE guid = ?', (sync_time, note_guid))
+
+    def expire_note_content(self, note_guid):
+        with self.transaction() as db:
+            db.execute('UPDATE notes SET sync_time = NULL WHERE guid = ?', (note_guid,))
+
+    def get_note_content_location(self, note_guid):
+        """
+        :return: (offset, length) in the content segment, None if content is not stored
+        """
+        with self.lock:
+            return self.connection.execute(
+                'SELECT offset, length FROM content_index WHERE guid = ?', (note_guid,)).fetchone()
+
+    def get_live_content_size(self):
+        with self.lock:
+            return self.connection.execute('SELECT COALESCE(SUM(length), 0) FROM content_index').fetchone()[0]
+
+    def load_content_index(self):
+        """
+        :return: list of (note_guid, offset, length), in segment order
+        """
+        with self.lock:
+            return self.connection.execute('SELECT guid, offset, length FROM content_index ORDER BY offset').fetchall()
+
+    def set_content_index(self, locations, segment_path):
+        """
+        switches the whole index to a compacted segment in one transaction
+        """
+        with self.transaction() as db:
+            db.executemany('UPDATE content_index SET offset = ?, length = ? WHERE guid = ?', [
+                (offset, length, note_guid) for note_guid, offset, length in locations])
+            db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', ('content_segment', segment_path))
+
+    def delete_note(self, note_guid):
+        with self.transaction() as db:
+            db.execute('DELETE FROM content_index WHERE guid = ?', (note_guid,))
+            db.execute('DELETE FROM notes WHERE guid = ?', (note_guid,))
+
+    def load_notebook_notes(self, notebook_guid):
+        """
+        :return: list of (note, ino, sync_time)
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT note, ino, sync_time FROM notes WHERE notebook_guid = ?', (notebook_guid,)).fetchall()
+        return [(pickle.loads(note), ino, sync_time) for note, ino, sync_time in rows]
+
+    def get_note_notebook_guid(self, note_guid):
+        with self.lock:
+            row = self.connection.execute('SELECT notebook_guid FROM notes WHERE guid = ?', (note_guid,)).fetchone()
+        return None if row is None else row[0]
+
+    def get_max_ino(self):
+        """
+        :return: highest inode number persisted for a notebook or a note, 0 if there is none
+        """
+        with self.lock:
+            return self.connection.execute(
+                'SELECT MAX(COALESCE((SELECT MAX(ino) FROM notebooks), 0), '
+                'COALESCE((SELECT MAX(ino) FROM notes), 0))').fetchone()[0]
@@ -0,0 +1,133 @@
+from __future__ import print_function, absolute_import, division
+
+from collections import defaultdict
+from math import frexp
+from threading import Lock
+from time import time
+
+HISTOGRAM_BUCKETS = 32  # bucket i counts latencies below 2^i microseconds, the last one counts the rest
+PROMETHEUS_PREFIX = 'evernotefuse_'
+
+
+class Histogram(object):
+
+    def __init__(self):
+        """
+        Latency histogram with power of two buckets, so adding a sample is constant time and
+        percentiles are accurate to a factor of two.
+        """
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds, failed=False):
+        index = frexp(seconds * 1e6)[1] if seconds >= 1e-6 else 0
+        self.buckets[min(index, HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.errors += failed
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percentile):
+        """
+        :return: upper bound in seconds of the bucket the percentile falls into, at most the maximum seen
+        """
+        rank = self.count * percentile / 100
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and seen > 0:
+                return min(2 ** index / 1e6, self.max)
+        return self.max
+
+
+class Metrics(object):
+
+    def __init__(self):
+        """
+        Request and API latency histograms and byte counters, kept in memory and rendered on demand.
+
+        Histograms are grouped in families, e.g. 'request' by FUSE operation and 'api' by note
+        store method. Recording takes one short lock, it is done on every request.
+        """
+        self.lock = Lock()
+        self.histograms = defaultdict(Histogram)
+        self.counters = defaultdict(int)
+        self.started = time()
+
+    def observe(self, family, name, seconds, failed=False):
+        with self.lock:
+            self.histograms[(family, name)].add(seconds, failed)
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def snapshot(self):
+        with self.lock:
+            histograms = {}
+            for key, histogram in self.histograms.items():
+                copied = Histogram()
+                copied.__dict__.update(histogram.__dict__, buckets=list(histogram.buckets))
+                histograms[key] = copied
+            return histograms, dict(self.counters)
+
+    def render_text(self, sections):
+        """
+        :param sections: list of (title, dict) with further statistics, e.g. of the content cache
+        """
+        histograms, counters = self.snapshot()
+        lines = ['uptime: %.0f s' % (time() - self.started)]
+        for family in sorted(set(family for family, name in histograms)):
+            lines.append('')
+            lines.append('%-22s %10s %8s %10s %10s %10s' % (family, 'count', 'errors', 'p50 ms', 'p99 ms', 'max ms'))
+            for (histogram_family, name), histogram in sorted(histograms.items()):
+                if histogram_family == family:
+                    lines.append('%-22s %10d %8d %10.3f %10.3f %10.3f' % (
+                        name, histogram.count, histogram.errors, histogram.percentile(50) * 1000,
+                        histogram.percentile(99) * 1000, histogram.max * 1000))
+        lines.append('')
+        for name, value in sorted(counters.items()):
+            lines.append(name + ': ' + str(value))
+        for title, stats in sections:
+            lines.append(title + ': ' + ' '.join(
+                key + '=' + (('%.3f' % value) if isinstance(value, float) else str(value))
+                for key, value in sorted(stats.items())))
+        return '\n'.join(lines) + '\n'
+
+    def render_prometheus(self, sections):
+        """
+        :param sections: as for render_text, numeric values are exported as gauges named <title>_<key>
+        """
+        histograms, counters = self.snapshot()
+        lines = ['# TYPE %suptime_seconds gauge' % PROMETHEUS_PREFIX,
+                 '%suptime_seconds %.3f' % (PROMETHEUS_PREFIX, time() - self.started)]
+        for family in sorted(set(family for family, name in histograms)):
+            metric = PROMETHEUS_PREFIX + family + '_seconds'
+            lines.append('# TYPE %s histogram' % metric)
+            for (histogram_family, name), histogram in sorted(histograms.items()):
+                if histogram_family != family:
+                    continue
+                label = 'name="%s"' % name
+                cumulative = 0
+                for index, count in enumerate(histogram.buckets[:-1]):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%g"} %d' % (metric, label, 2 ** index / 1e6, cumulative))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (metric, label, histogram.count))
+                lines.append('%s_sum{%s} %.6f' % (metric, label, histogram.sum))
+                lines.append('%s_count{%s} %d' % (metric, label, histogram.count))
+            lines.append('# TYPE %s_errors_total counter' % (PROMETHEUS_PREFIX + family))
+            for (histogram_family, name), histogram in sorted(histograms.items()):
+                if histogram_family == family:
+                    lines.append('%s_errors_total{name="%s"} %d' % (PROMETHEUS_PREFIX + family, name, histogram.errors))
+        for name, value in sorted(counters.items()):
+            lines.append('# TYPE %s%s_total counter' % (PROMETHEUS_PREFIX, name))
+            lines.append('%s%s_total %d' % (PROMETHEUS_PREFIX, name, value))
+        for title, stats in sections:
+            for key, value in sorted(stats.items()):
+                if isinstance(value, (int, float)):
+                    lines.append('# TYPE %s%s_%s gauge' % (PROMETHEUS_PREFIX, title, key))
+                    lines.append('%s%s_%s %g' % (PROMETHEUS_PREFIX, title, key, value))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,191 @@
+from __future__ import print_function, absolute_import, division
+
+from collections import defaultdict, deque
+from threading import Condition, Thread, current_thread, enumerate as enumerate_threads
+from time import sleep, strftime, time
+import logging
+import os
+import signal
+import sys
+import tracemalloc
+
+PROFILE_KINDS = ('cpu', 'memory')
+CONTROL_POLL_PERIOD = 1.0  # seconds between checks of the control file
+TRACEMALLOC_FRAMES = 25
+MEMORY_TOP_STATS = 10  # allocation sites logged after a memory profile
+
+
+class Profiler(object):
+
+    def __init__(self, directory, duration, interval, get_tags=None, signals=None, control_file=None):
+        """
+        Profiles a running filesystem on request, without restarting it.
+
+        A CPU profile samples the stacks of all threads every interval seconds. A memory profile
+        traces allocations with tracemalloc and snapshots the ones still alive at its end. Both are
+        written to directory as collapsed stacks, one 'frame;frame;... count' line per stack, which
+        flamegraph.pl and speedscope read. Profiles run one at a time, in a thread of their own.
+
+        :param duration: seconds a profile runs, unless requested otherwise
+        :param interval: seconds between CPU samples
+        :param get_tags: returns a dict of thread ident to a tag, e.g. the FUSE operation it serves,
+                         put after the thread name in sampled stacks
+        :param signals: dict of signal number to the profile kind it requests. The signals are
+                        blocked in the calling thread and the threads it starts later, a thread of
+                        the profiler waits for them; other threads must not be running yet, or
+                        they may take a signal with its default action
+        :param control_file: path checked every CONTROL_POLL_PERIOD for '<kind> [seconds]', it is
+                             removed once read
+        """
+        self.directory = directory
+        self.duration = duration
+        self.interval = interval
+        self.get_tags = get_tags or dict
+        self.control_file = control_file
+        self.requests = deque()
+        self.running = None
+        self.stopped = False
+        self.condition = Condition()
+        self.stats = dict(cpu=0, memory=0, samples=0)
+
+        if signals:
+            signal.pthread_sigmask(signal.SIG_BLOCK, list(signals))
+            thread = Thread(target=self.wait_signals, args=(signals,), name='profiler-signals')
+            thread.daemon = True
+            thread.start()
+        self.thread = Thread(target=self.work, name='profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self, kind, duration=None):
+        """
+        :param kind: 'cpu' or 'memory'
+        """
+        if kind not in PROFILE_KINDS:
+            raise ValueError('Unknown profile: ' + kind)
+        with self.condition:
+            self.requests.append((kind, duration or self.duration))
+            self.condition.notify()
+
+    def wait_signals(self, signals):
+        while True:
+            signum = signal.sigwait(list(signals))
+            logging.info('profiler: received signal ' + str(signum))
+            self.request(signals[signum])
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.requests and not self.stopped:
+                    self.condition.wait(CONTROL_POLL_PERIOD if self.control_file else None)
+                    if self.control_file and not self.requests:
+                        self.read_control_file()
+                if self.stopped:
+                    return
+                kind, duration = self.requests.popleft()
+                self.running = kind
+
+            try:
+                path = getattr(self, 'profile_' + kind)(duration)
+                logging.info('profiler: ' + kind + ' profile written to ' + path)
+            except Exception:
+                logging.exception('profiler: ' + kind + ' profile failed')
+            with self.condition:
+                self.running = None
+                self.stats[kind] += 1
+
+    def read_control_file(self):
+        try:
+            with open(self.control_file) as f:
+                command = f.read().split()
+            os.remove(self.control_file)
+        except EnvironmentError:
+            return
+        if not command or command[0] not in PROFILE_KINDS:
+            logging.warning('profiler: expected "cpu [seconds]" or "memory [seconds]" in ' + self.control_file)
+            return
+        try:
+            duration = float(command[1]) if len(command) > 1 else self.duration
+        except ValueError:
+            duration = self.duration
+        self.requests.append((command[0], duration))
+
+    def get_output_path(self, kind):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        return os.path.join(self.directory, kind + '-' + strftime('%Y%m%d-%H%M%S') + '.folded')
+
+    def profile_cpu(self, duration):
+        """
+        :return: path of the collapsed stacks, counted in samples
+        """
+        stacks = defaultdict(int)
+        own = current_thread().ident
+        deadline = time() + duration
+        while time() < deadline:
+            names = dict((thread.ident, thread.name) for thread in enumerate_threads())
+            tags = self.get_tags()
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(format_frame(frame.f_code.co_filename, frame.f_code.co_name))
+                    frame = frame.f_back
+                stack.append(clean_frame(names.get(ident, str(ident))))
+                stack.reverse()
+                if ident in tags:
+                    stack.insert(1, clean_frame(tags[ident]))
+                stacks[';'.join(stack)] += 1
+            self.stats['samples'] += 1
+            sleep(self.interval)
+        return self.write_stacks('cpu', stacks)
+
+    def profile_memory(self, duration):
+        """
+        :return: path of the collapsed stacks, counted in bytes allocated and not freed at the end
+        """
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        try:
+            sleep(duration)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        stacks = defaultdict(int)
+        for statistic in snapshot.statistics('traceback'):
+            # frames are sorted from the oldest call
+            stack = [format_frame(frame.filename, str(frame.lineno)) for frame in statistic.traceback]
+            stacks[';'.join(stack)] += statistic.size
+        for statistic in snapshot.statistics('lineno')[:MEMORY_TOP_STATS]:
+            logging.info('profiler: ' + str(statistic))
+        return self.write_stacks('memory', stacks)
+
+    def write_stacks(self, kind, stacks):
+        path = self.get_output_path(kind)
+        with open(path, 'w') as f:
+            for stack, value in sorted(stacks.items()):
+                f.write(stack + ' ' + str(value) + '\n')
+        return path
+
+    def get_stats(self):
+        with self.condition:
+            return dict(self.stats, queued=len(self.requests), running=int(self.running is not None))
+
+
+def format_frame(filename, name):
+    return clean_frame(os.path.basename(filename) + ':' + name)
+
+
+def clean_frame(frame):
+    # ';' separates frames and the last space the count, neither may appear in a frame
+    return frame.replace(';', ',').replace(' ', '_')
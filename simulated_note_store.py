@@ -0,0 +1,317 @@
+from __future__ import print_function, absolute_import, division
+
+from collections import defaultdict, deque
+from copy import copy
+from hashlib import md5
+from random import Random
+from threading import Lock
+from time import sleep, time
+import uuid
+
+from thrift.protocol.TBinaryProtocol import TBinaryProtocol
+
+from evernote.edam.error.ttypes import EDAMErrorCode, EDAMNotFoundException, EDAMSystemException, \
+    EDAMUserException
+from evernote.edam.notestore.ttypes import NoteList, NoteMetadata, NotesMetadataList, SyncChunk, SyncState
+from evernote.edam.type.ttypes import Data, Note, NoteAttributes, Notebook, Resource
+
+SIMULATED_RATE_LIMIT_PERIOD = 60 * 60  # seconds, calls are limited per hour as Evernote does
+SIMULATED_TEXT = ('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor '
+                  'incididunt ut labore et dolore magna aliqua. ')
+NOTE_HEAD = ('<?xml version="1.0" encoding="UTF-8"?>'
+             '<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">')
+
+
+class CountingTransport(object):
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, buf):
+        self.size += len(buf)
+
+
+def serialized_size(value):
+    """
+    :return: bytes a thrift struct, a list of them or a string take on the wire
+    """
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, list):
+        return sum(serialized_size(item) for item in value)
+    transport = CountingTransport()
+    value.write(TBinaryProtocol(transport))
+    return transport.size
+
+
+class SimulatedEvernoteClient(object):
+
+    def __init__(self, note_store):
+        self.note_store = note_store
+
+    def get_note_store(self):
+        return self.note_store
+
+
+class SimulatedNoteStore(object):
+
+    def __init__(self, notebooks=10, notes_per_notebook=100, content_size=2048, latency=0.0, bandwidth=None,
+                 calls_per_hour=None, rate_limit_duration=None, failure_rate=0.0, seed=0):
+        """
+        In-process Evernote account, serving the NoteStore calls EvernoteFuse makes.
+
+        The account is generated from seed, so the same settings give the same notebooks, notes
+        and guids on every run. Every call takes latency seconds plus the time its request and
+        response take at bandwidth bytes per second, sized as thrift binary encoding. Changes are
+        kept in memory only and update sequence numbers are kept, so incremental sync works.
+
+        :param content_size: average note content size in bytes
+        :param bandwidth: bytes per second, None for no transfer time
+        :param calls_per_hour: calls past this within an hour fail with RATE_LIMIT_REACHED, None for no limit
+        :param rate_limit_duration: rateLimitDuration reported, by default until the oldest call leaves the hour
+        :param failure_rate: share of calls failing with an EDAMSystemException, as a flaky connection would
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.calls_per_hour = calls_per_hour
+        self.rate_limit_duration = rate_limit_duration
+        self.failure_rate = failure_rate
+        self.random = Random(seed)
+        self.lock = Lock()
+        self.calls = deque()
+        self.stats = dict(calls=0, transferred=0, rate_limited=0, failed=0)
+        self.method_calls = defaultdict(int)
+
+        self.update_count = 0
+        self.notebooks = {}
+        self.notes = {}
+        self.contents = {}
+        self.expunged_notes = []
+
+        for i in range(notebooks):
+            notebook = self.add_notebook('Notebook ' + str(i))
+            for j in range(notes_per_notebook):
+                size = self.random.randint(content_size // 2, content_size * 3 // 2)
+                text = (SIMULATED_TEXT * (size // len(SIMULATED_TEXT) + 1))[:size]
+                self.add_note(notebook.guid, 'Note ' + str(j), text)
+
+    def create_guid(self):
+        return str(uuid.UUID(int=self.random.getrandbits(128)))
+
+    def next_usn(self):
+        self.update_count += 1
+        return self.update_count
+
+    def add_notebook(self, name):
+        with self.lock:
+            notebook = Notebook(
+                guid=self.create_guid(), name=name, updateSequenceNum=self.next_usn(),
+                serviceCreated=int(time() * 1000), serviceUpdated=int(time() * 1000))
+            self.notebooks[notebook.guid] = notebook
+            return notebook
+
+    def add_note(self, notebook_guid, title, text):
+        """
+        adds a note as if it was created from another client
+        """
+        with self.lock:
+            now = int(time() * 1000)
+            guid = self.create_guid()
+            note = Note(
+                guid=guid, title=title, notebookGuid=notebook_guid, created=now, updated=now, active=True,
+                tagGuids=[self.create_guid() for i in range(2)],
+                attributes=NoteAttributes(author='simulated@example.com', source='web.clip',
+                                          sourceURL='https://example.com/' + guid),
+                resources=[Resource(guid=self.create_guid(), noteGuid=guid, mime='image/png', width=640,
+                                    height=480, active=True, data=Data(bodyHash=md5(guid.encode()).digest(),
+                                                                       size=20000))])
+            self.set_content(note, NOTE_HEAD + '<en-note>' + text + '</en-note>')
+            note.updateSequenceNum = self.next_usn()
+            self.notes[guid] = note
+            return note
+
+    def edit_note(self, note_guid, text):
+        """
+        changes a note as if it was edited from another client
+        """
+        with self.lock:
+            note = self.notes[note_guid]
+            self.set_content(note, NOTE_HEAD + '<en-note>' + text + '</en-note>')
+            note.updated = int(time() * 1000)
+            note.updateSequenceNum = self.next_usn()
+
+    def expunge_note(self, note_guid):
+        with self.lock:
+            del self.notes[note_guid]
+            del self.contents[note_guid]
+            self.expunged_notes.append((self.next_usn(), note_guid))
+
+    def change_tag(self):
+        """
+        moves the update count as renaming a tag from another client does, no synced note or notebook changes
+        """
+        with self.lock:
+            return self.next_usn()
+
+    def set_content(self, note, content):
+        content_bytes = content.encode('utf-8')
+        note.contentHash = md5(content_bytes).digest()
+        note.contentLength = len(content_bytes)
+        self.contents[note.guid] = content
+
+    def begin(self, method):
+        """
+        counts a call against the rate limit and fails it when the limit or a failure is simulated
+        """
+        with self.lock:
+            now = time()
+            self.stats['calls'] += 1
+            self.method_calls[method] += 1
+            while self.calls and self.calls[0] <= now - SIMULATED_RATE_LIMIT_PERIOD:
+                self.calls.popleft()
+            if self.calls_per_hour is not None and len(self.calls) >= self.calls_per_hour:
+                self.stats['rate_limited'] += 1
+                duration = self.rate_limit_duration
+                if duration is None:
+                    duration = int(self.calls[0] + SIMULATED_RATE_LIMIT_PERIOD - now) + 1
+                raise EDAMSystemException(errorCode=EDAMErrorCode.RATE_LIMIT_REACHED, rateLimitDuration=duration)
+            self.calls.append(now)
+            if self.failure_rate and self.random.random() < self.failure_rate:
+                self.stats['failed'] += 1
+                raise EDAMSystemException(errorCode=EDAMErrorCode.UNKNOWN, message='simulated failure')
+
+    def transfer(self, request, response):
+        size = serialized_size(request) + serialized_size(response)
+        with self.lock:
+            self.stats['transferred'] += size
+        delay = self.latency + (size / self.bandwidth if self.bandwidth else 0)
+        if delay > 0:
+            sleep(delay)
+        return response
+
+    def get_stats(self):
+        """
+        :return: counters, methods being the calls per note store method and notes the notes stored
+        """
+        with self.lock:
+            return dict(self.stats, methods=dict(self.method_calls), notes=len(self.notes))
+
+    def find_notebook_notes(self, note_filter):
+        notes = [note for note in self.notes.values()
+                 if note_filter.notebookGuid is None or note.notebookGuid == note_filter.notebookGuid]
+        notes.sort(key=lambda note: (note.created, note.guid))
+        return notes
+
+    def chunk_note(self, note, sync_filter):
+        note = copy(note)
+        if not sync_filter.includeNoteAttributes:
+            note.attributes = None
+        if not sync_filter.includeNoteResources:
+            note.resources = None
+        return note
+
+    def listNotebooks(self):
+        self.begin('listNotebooks')
+        with self.lock:
+            notebooks = [copy(notebook) for notebook in self.notebooks.values()]
+        return self.transfer(None, notebooks)
+
+    def findNotes(self, note_filter, offset, max_notes):
+        self.begin('findNotes')
+        with self.lock:
+            notes = self.find_notebook_notes(note_filter)
+            page = [copy(note) for note in notes[offset:offset + max_notes]]
+        return self.transfer(note_filter, NoteList(startIndex=offset, totalNotes=len(notes), notes=page))
+
+    def findNotesMetadata(self, note_filter, offset, max_notes, result_spec):
+        self.begin('findNotesMetadata')
+        with self.lock:
+            notes = self.find_notebook_notes(note_filter)
+            page = [NoteMetadata(
+                guid=note.guid,
+                title=note.title if result_spec.includeTitle else None,
+                contentLength=note.contentLength if result_spec.includeContentLength else None,
+                created=note.created if result_spec.includeCreated else None,
+                updated=note.updated if result_spec.includeUpdated else None,
+                updateSequenceNum=note.updateSequenceNum if result_spec.includeUpdateSequenceNum else None,
+                notebookGuid=note.notebookGuid if result_spec.includeNotebookGuid else None,
+                tagGuids=note.tagGuids if result_spec.includeTagGuids else None,
+                attributes=note.attributes if result_spec.includeAttributes else None)
+                for note in notes[offset:offset + max_notes]]
+        return self.transfer(
+            note_filter, NotesMetadataList(startIndex=offset, totalNotes=len(notes), notes=page))
+
+    def getNoteContent(self, note_guid):
+        self.begin('getNoteContent')
+        with self.lock:
+            if note_guid not in self.contents:
+                raise EDAMNotFoundException(identifier='Note.guid', key=note_guid)
+            content = self.contents[note_guid]
+        return self.transfer(note_guid, content)
+
+    def createNote(self, note):
+        self.begin('createNote')
+        with self.lock:
+            if not note.title:
+                raise EDAMUserException(errorCode=EDAMErrorCode.BAD_DATA_FORMAT, parameter='Note.title')
+            if note.notebookGuid not in self.notebooks:
+                raise EDAMNotFoundException(identifier='Note.notebookGuid', key=note.notebookGuid)
+            now = int(time() * 1000)
+            created = Note(
+                guid=self.create_guid(), title=note.title, notebookGuid=note.notebookGuid,
+                created=now, updated=now, active=True)
+            self.set_content(created, note.content)
+            created.updateSequenceNum = self.next_usn()
+            self.notes[created.guid] = created
+            created = copy(created)
+        return self.transfer(note, created)
+
+    def updateNote(self, note):
+        self.begin('updateNote')
+        with self.lock:
+            if note.guid not in self.notes:
+                raise EDAMNotFoundException(identifier='Note.guid', key=note.guid)
+            if note.notebookGuid not in self.notebooks:
+                raise EDAMNotFoundException(identifier='Note.notebookGuid', key=note.notebookGuid)
+            updated = self.notes[note.guid]
+            updated.title = note.title
+            updated.notebookGuid = note.notebookGuid
+            if note.content is not None:
+                self.set_content(updated, note.content)
+            updated.updated = int(time() * 1000)
+            updated.updateSequenceNum = self.next_usn()
+            updated = copy(updated)
+        return self.transfer(note, updated)
+
+    def getSyncState(self):
+        self.begin('getSyncState')
+        with self.lock:
+            state = SyncState(
+                currentTime=int(time() * 1000), fullSyncBefore=0, updateCount=self.update_count, uploaded=0)
+        return self.transfer(None, state)
+
+    def getFilteredSyncChunk(self, after_usn, max_entries, sync_filter):
+        self.begin('getFilteredSyncChunk')
+        with self.lock:
+            entries = []
+            if sync_filter.includeNotebooks:
+                entries += [(notebook.updateSequenceNum, 'notebook', notebook) for notebook in self.notebooks.values()
+                            if notebook.updateSequenceNum > after_usn]
+            if sync_filter.includeNotes:
+                entries += [(note.updateSequenceNum, 'note', note) for note in self.notes.values()
+                            if note.updateSequenceNum > after_usn]
+            if sync_filter.includeExpunged:
+                entries += [(usn, 'expunged_note', note_guid) for usn, note_guid in self.expunged_notes
+                            if usn > after_usn]
+            entries.sort(key=lambda entry: entry[0])
+            entries = entries[:max_entries]
+
+            chunk = SyncChunk(
+                currentTime=int(time() * 1000), updateCount=self.update_count,
+                chunkHighUSN=entries[-1][0] if entries else None,
+                notebooks=[copy(value) for usn, kind, value in entries if kind == 'notebook'],
+                notes=[self.chunk_note(value, sync_filter) for usn, kind, value in entries if kind == 'note'],
+                expungedNotes=[value for usn, kind, value in entries if kind == 'expunged_note'])
+        return self.transfer(sync_filter, chunk)
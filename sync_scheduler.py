@@ -0,0 +1,152 @@
+from __future__ import print_function, absolute_import, division
+
+from heapq import heappush, heappop
+from itertools import count
+from threading import Condition, Thread
+from time import time
+import logging
+
+from api_dispatcher import RateLimited
+
+PRIORITY_FOREGROUND = 0
+PRIORITY_BACKGROUND = 1
+
+SYNC_RETRY_DELAY = 60.0  # seconds, to wait before retrying a failed periodic job
+SYNC_BUSY_DELAY = 1.0  # seconds, to postpone a job while the same key is synced by someone else
+
+
+class SyncJob(object):
+
+    def __init__(self, key, fn, args, due, priority, period, seq):
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.due = due
+        self.priority = priority
+        self.period = period
+        self.seq = seq
+        self.cancelled = False
+
+
+class SyncScheduler(object):
+
+    def __init__(self, workers):
+        """
+        Runs sync jobs in background worker threads.
+
+        Jobs wait in a heap ordered by due time; once due, they move to a ready heap ordered by
+        priority, so that a foreground refresh overtakes queued background work. There is at most
+        one queued job per key.
+        """
+        self.condition = Condition()
+        self.waiting = []
+        self.ready = []
+        self.jobs = {}
+        self.running = set()
+        self.seq = count()
+        self.stopped = False
+
+        self.threads = []
+        for i in range(workers):
+            thread = Thread(target=self.work, name='sync-' + str(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def schedule(self, key, fn, args=(), delay=0.0, priority=PRIORITY_BACKGROUND, period=None):
+        """
+        queue fn(*args) to run after delay seconds.
+
+        If period is set, the job is queued again after it runs, unless fn returns False.
+        A job already queued under the same key is moved earlier instead of being queued twice.
+        """
+        due = time() + delay
+        with self.condition:
+            if self.stopped:
+                return
+
+            queued = self.jobs.get(key)
+            if queued is not None:
+                if (queued.due, queued.priority) <= (due, priority):
+                    queued.period = queued.period or period
+                    return
+                queued.cancelled = True
+                period = period or queued.period
+
+            job = SyncJob(key, fn, args, due, priority, period, next(self.seq))
+            self.jobs[key] = job
+            heappush(self.waiting, (job.due, job.seq, job))
+            self.condition.notify_all()
+
+    def run(self, key, fn, args=()):
+        """
+        run fn(*args) in the calling thread, or wait for a worker that is already running the same key
+        """
+        with self.condition:
+            if key in self.running:
+                while key in self.running:
+                    self.condition.wait()
+                return
+            self.running.add(key)
+
+        try:
+            return fn(*args)
+        finally:
+            with self.condition:
+                self.running.discard(key)
+                self.condition.notify_all()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def next_job(self):
+        while not self.stopped:
+            now = time()
+            while self.waiting and self.waiting[0][0] <= now:
+                job = heappop(self.waiting)[2]
+                if not job.cancelled:
+                    heappush(self.ready, (job.priority, job.seq, job))
+
+            while self.ready:
+                job = heappop(self.ready)[2]
+                if job.cancelled:
+                    continue
+                if job.key in self.running:
+                    # the same key is being synced right now, check again once it is likely done
+                    job.due = now + SYNC_BUSY_DELAY
+                    heappush(self.waiting, (job.due, job.seq, job))
+                    continue
+                del self.jobs[job.key]
+                self.running.add(job.key)
+                return job
+
+            self.condition.wait(self.waiting[0][0] - now if self.waiting else None)
+
+    def work(self):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                if job is None:
+                    return
+
+            delay = job.period
+            try:
+                if job.fn(*job.args) is False:
+                    delay = None
+            except RateLimited as e:
+                # the job still has to run, even if it is not periodic
+                logging.info('sync job postponed: ' + str(job.key) + ', ' + str(e))
+                delay = e.retry_after
+            except Exception:
+                logging.exception('sync job failed: ' + str(job.key))
+                if delay is not None:
+                    delay = SYNC_RETRY_DELAY
+            finally:
+                with self.condition:
+                    self.running.discard(job.key)
+                    self.condition.notify_all()
+
+            if delay is not None:
+                self.schedule(job.key, job.fn, job.args, delay, job.priority, job.period)
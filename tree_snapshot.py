@@ -0,0 +1,162 @@
+from __future__ import print_function, absolute_import, division
+
+from mmap import mmap, ACCESS_READ
+import os
+import struct
+
+from evernote.edam.type.ttypes import Note, Notebook
+
+SNAPSHOT_MAGIC = b'EFTS'
+SNAPSHOT_VERSION = 1
+
+# magic, version, reserved, generation, notebooks, notes, string table bytes
+HEADER = struct.Struct('<4sHHQIIQ')
+# guid and name as (offset, length) in the string table, ino, notes_sync_time, flags, first note, notes
+NOTEBOOK_RECORD = struct.Struct('<IIIIQdBII')
+# guid and title as (offset, length), ino, created, updated, contentLength, updateSequenceNum,
+# sync_time, contentHash, flags
+NOTE_RECORD = struct.Struct('<IIIIQqqiid16sB')
+
+# set in flags for the fields that are not None
+HAS_SYNC_TIME = 1
+HAS_CREATED = 2
+HAS_UPDATED = 4
+HAS_CONTENT_LENGTH = 8
+HAS_USN = 16
+HAS_CONTENT_HASH = 32
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class StringTable(object):
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def add(self, string):
+        """
+        :return: (offset, length) of the utf-8 encoded string
+        """
+        encoded = string.encode('utf-8')
+        offset = len(self.data)
+        self.data.extend(encoded)
+        return offset, len(encoded)
+
+
+def write_snapshot(path, generation, notebooks):
+    """
+    Writes notebooks and note metadata, replacing the file at path only once it is complete.
+
+    The notes of a notebook are stored next to each other, so they can be read without decoding
+    the others. Notes keep the fields the tree uses, as notes listed by findNotesMetadata do.
+
+    :param generation: number the reader compares with its own, to tell whether the snapshot is current
+    :param notebooks: list of (notebook, ino, notes_sync_time, notes), notes being a list of (note, ino, sync_time)
+    """
+    strings = StringTable()
+    notebook_records = []
+    note_records = []
+    for notebook, ino, notes_sync_time, notes in notebooks:
+        first_note = len(note_records)
+        for note, note_ino, sync_time in notes:
+            flags = ((HAS_SYNC_TIME if sync_time is not None else 0) |
+                     (HAS_CREATED if note.created is not None else 0) |
+                     (HAS_UPDATED if note.updated is not None else 0) |
+                     (HAS_CONTENT_LENGTH if note.contentLength is not None else 0) |
+                     (HAS_USN if note.updateSequenceNum is not None else 0) |
+                     (HAS_CONTENT_HASH if note.contentHash is not None else 0))
+            note_records.append(NOTE_RECORD.pack(*(strings.add(note.guid) + strings.add(note.title) + (
+                note_ino, note.created or 0, note.updated or 0, note.contentLength or 0,
+                note.updateSequenceNum or 0, sync_time or 0.0, note.contentHash or b'', flags))))
+        notebook_records.append(NOTEBOOK_RECORD.pack(*(strings.add(notebook.guid) + strings.add(notebook.name) + (
+            ino, notes_sync_time or 0.0, HAS_SYNC_TIME if notes_sync_time is not None else 0,
+            first_note, len(note_records) - first_note))))
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, generation,
+                            len(notebook_records), len(note_records), len(strings.data)))
+        f.write(b''.join(notebook_records))
+        f.write(b''.join(note_records))
+        f.write(strings.data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, path)
+
+
+class TreeSnapshot(object):
+
+    def __init__(self, path):
+        """
+        Snapshot written by write_snapshot, mapped into memory. Opening it only reads the header and
+        the notebook records, notes are decoded when the notes of their notebook are asked for.
+
+        :raise SnapshotError: the file is not a snapshot of this version or it is truncated
+        :raise EnvironmentError: the file can not be read
+        """
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                raise SnapshotError('Snapshot is truncated: ' + path)
+            self.buffer = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+        magic, version, reserved, self.generation, notebooks_count, notes_count, strings_size = \
+            HEADER.unpack_from(self.buffer)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            self.buffer.close()
+            raise SnapshotError('Not a snapshot of version ' + str(SNAPSHOT_VERSION) + ': ' + path)
+        self.notes_offset = HEADER.size + notebooks_count * NOTEBOOK_RECORD.size
+        self.strings_offset = self.notes_offset + notes_count * NOTE_RECORD.size
+        if self.strings_offset + strings_size != size:
+            self.buffer.close()
+            raise SnapshotError('Snapshot is truncated: ' + path)
+
+        self.notebooks = [
+            NOTEBOOK_RECORD.unpack_from(self.buffer, HEADER.size + i * NOTEBOOK_RECORD.size)
+            for i in range(notebooks_count)]
+        self.notebook_index = dict(
+            (self.get_string(record[0], record[1]), i) for i, record in enumerate(self.notebooks))
+
+    def get_string(self, offset, length):
+        start = self.strings_offset + offset
+        return self.buffer[start:start + length].decode('utf-8')
+
+    def get_notebooks(self):
+        """
+        :return: list of (notebook, ino, notes_sync_time)
+        """
+        return [(
+            Notebook(guid=self.get_string(guid_offset, guid_length), name=self.get_string(name_offset, name_length)),
+            ino,
+            notes_sync_time if flags & HAS_SYNC_TIME else None)
+            for guid_offset, guid_length, name_offset, name_length, ino, notes_sync_time, flags, first_note, notes_count
+            in self.notebooks]
+
+    def get_notebook_notes(self, notebook_guid):
+        """
+        :return: list of (note, ino, sync_time), empty if the notebook is not in the snapshot
+        """
+        if notebook_guid not in self.notebook_index:
+            return []
+        first_note, notes_count = self.notebooks[self.notebook_index[notebook_guid]][7:]
+        start = self.notes_offset + first_note * NOTE_RECORD.size
+        notes = []
+        for (guid_offset, guid_length, title_offset, title_length, ino, created, updated, content_length, usn,
+             sync_time, content_hash, flags) in NOTE_RECORD.iter_unpack(
+                self.buffer[start:start + notes_count * NOTE_RECORD.size]):
+            notes.append((Note(
+                guid=self.get_string(guid_offset, guid_length),
+                title=self.get_string(title_offset, title_length),
+                notebookGuid=notebook_guid,
+                created=created if flags & HAS_CREATED else None,
+                updated=updated if flags & HAS_UPDATED else None,
+                contentLength=content_length if flags & HAS_CONTENT_LENGTH else None,
+                updateSequenceNum=usn if flags & HAS_USN else None,
+                contentHash=content_hash if flags & HAS_CONTENT_HASH else None,
+                active=True), ino, sync_time if flags & HAS_SYNC_TIME else None))
+        return notes
+
+    def close(self):
+        self.buffer.close()
@@ -0,0 +1,180 @@
+from __future__ import print_function, absolute_import, division
+
+from collections import deque
+from heapq import heappush, heappop
+from itertools import count
+from threading import Condition, Thread
+from time import time
+import logging
+
+from api_dispatcher import RateLimited
+
+UPLOAD_RETRY_DELAY = 60.0  # seconds, to wait before retrying a failed upload
+UPLOAD_BUSY_DELAY = 1.0  # seconds, to postpone an upload while the same inode is being uploaded
+UPLOAD_LATENCY_SAMPLES = 1000  # recent uploads the latency percentiles are computed over
+
+
+class UploadJob(object):
+
+    def __init__(self, ino, queued):
+        self.ino = ino
+        self.kinds = set()
+        self.queued = queued
+        self.due = None
+        self.seq = None
+
+
+class UploadQueue(object):
+
+    def __init__(self, workers, upload):
+        """
+        Uploads local changes from a bounded pool of worker threads.
+
+        Pending uploads wait in one heap ordered by due time. Changes to an inode queued before its
+        upload starts are coalesced into it and push it back by their delay, so a burst of writes
+        ends in a single upload. Changes queued while the inode is being uploaded go into the next one.
+        flush() uploads the changes of an inode at once, in the calling thread, and drain() all of them.
+
+        :param upload: called as upload(ino, kinds), kinds being the set of queued change kinds
+        """
+        self.upload = upload
+        self.condition = Condition()
+        self.waiting = []
+        self.pending = {}
+        self.running = set()
+        self.seq = count()
+        self.stopped = False
+        self.latencies = deque(maxlen=UPLOAD_LATENCY_SAMPLES)
+        self.stats = dict(queued=0, coalesced=0, uploaded=0, failed=0)
+
+        self.threads = []
+        for i in range(workers):
+            thread = Thread(target=self.work, name='upload-' + str(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def add(self, ino, kind, delay):
+        """
+        queue a change of ino to be uploaded delay seconds after the last change queued for it
+        """
+        with self.condition:
+            self.stats['queued'] += 1
+            self.queue(ino, [kind], delay)
+
+    def queue(self, ino, kinds, delay, queued=None):
+        job = self.pending.get(ino)
+        if job is None:
+            job = self.pending[ino] = UploadJob(ino, queued or time())
+        else:
+            self.stats['coalesced'] += 1
+        job.kinds.update(kinds)
+        job.due = time() + delay
+        job.seq = next(self.seq)
+        heappush(self.waiting, (job.due, job.seq, job))
+        self.condition.notify_all()
+
+    def reschedule(self, ino, delay):
+        """
+        move the pending upload of ino to delay seconds from now, nothing is done if none is pending
+        """
+        with self.condition:
+            job = self.pending.get(ino)
+            if job is not None:
+                self.queue(ino, (), delay)
+
+    def flush(self, ino):
+        """
+        uploads the pending changes of ino in the calling thread, after the upload of ino in progress if any
+        :return: False if the upload failed, it is then retried in background
+        """
+        with self.condition:
+            while ino in self.running and not self.stopped:
+                self.condition.wait()
+            job = self.pending.pop(ino, None)
+            if job is None:
+                return True
+            self.running.add(ino)
+        return self.run(job)
+
+    def drain(self):
+        """
+        stops the workers, then uploads all pending changes in the calling thread, oldest first
+        :return: inodes whose upload failed, their changes stay pending
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+            while self.running:
+                self.condition.wait()
+            jobs = sorted(self.pending.values(), key=lambda job: job.queued)
+            self.pending.clear()
+            self.running.update(job.ino for job in jobs)
+        return [job.ino for job in jobs if not self.run(job)]
+
+    def cancel(self, ino):
+        with self.condition:
+            self.pending.pop(ino, None)
+
+    def next_job(self):
+        while not self.stopped:
+            now = time()
+            while self.waiting and self.waiting[0][0] <= now:
+                due, seq, job = heappop(self.waiting)
+                if job.seq != seq or self.pending.get(job.ino) is not job:
+                    # superseded by a later change or cancelled
+                    continue
+                if job.ino in self.running:
+                    job.due = now + UPLOAD_BUSY_DELAY
+                    job.seq = next(self.seq)
+                    heappush(self.waiting, (job.due, job.seq, job))
+                    continue
+                del self.pending[job.ino]
+                self.running.add(job.ino)
+                return job
+
+            self.condition.wait(self.waiting[0][0] - now if self.waiting else None)
+
+    def work(self):
+        while True:
+            with self.condition:
+                job = self.next_job()
+                if job is None:
+                    return
+            self.run(job)
+
+    def run(self, job):
+        failed = False
+        retry_delay = UPLOAD_RETRY_DELAY
+        try:
+            self.upload(job.ino, job.kinds)
+        except RateLimited as e:
+            logging.info('upload postponed: ' + str(job.ino) + ', ' + str(e))
+            failed = True
+            retry_delay = e.retry_after
+        except Exception:
+            logging.exception('upload failed: ' + str(job.ino))
+            failed = True
+        finally:
+            with self.condition:
+                self.running.discard(job.ino)
+                if failed:
+                    self.stats['failed'] += 1
+                    self.queue(job.ino, job.kinds, retry_delay, job.queued)
+                else:
+                    self.stats['uploaded'] += 1
+                    self.latencies.append(time() - job.queued)
+                self.condition.notify_all()
+        return not failed
+
+    def get_stats(self):
+        """
+        :return: counters, queue depth and upload latency percentiles in seconds, from the first
+                 queued change to the end of the upload
+        """
+        with self.condition:
+            latencies = sorted(self.latencies)
+            stats = dict(self.stats, depth=len(self.pending), running=len(self.running))
+        for name, percentile in (('latency_p50', 50), ('latency_p99', 99)):
+            stats[name] = latencies[len(latencies) * percentile // 100] if latencies else 0.0
+        return stats